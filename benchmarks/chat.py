@@ -0,0 +1,198 @@
+"""
+Measures how many replies the chat cog delivers per second and how long they take, offline.
+
+The cog is driven with fake Discord objects against a stub OpenAI API and a throwaway database, so nothing but
+this machine is measured. Every channel sends a message, waits for Osiris to reply and sends the next one, with all
+channels running concurrently. Reply latency runs from the message to the first message of the reply (the first
+piece of a streamed one), and the next message is sent once the whole reply is out. Replies turned away because
+the inference queue is full count as failures. The stub shares the event loop with the bot, so its own overhead is included.
+
+    python -m benchmarks.chat --scenario busy
+    python -m benchmarks.chat --guilds 100 --channels 5 --messages 10 --latency 1.0 --error-rate 0.05 --stream
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+from benchmarks.fake_discord import FakeBot, FakeChannel, FakeGuild, FakeMessage, FakeUser
+from benchmarks.stats import percentile
+from benchmarks.stub_openai import StubOpenAI
+
+# defaults of each preset, with room in the queue for every channel's reply so that none is turned away, and more
+# workers for the largest one so its replies finish within their deadline
+SCENARIOS = {
+    "single": {"guilds": 1, "channels": 1, "messages": 50},
+    "busy": {"guilds": 10, "channels": 10, "messages": 20},
+    "wide": {"guilds": 1000, "channels": 2, "messages": 3, "queue_size": 2000},
+    "huge": {"guilds": 10000, "channels": 3, "messages": 1, "queue_size": 30000, "workers": 256, "connections": 256},
+}
+
+REPLY_TIMEOUT = 120
+
+
+async def setup_database(path: str, guilds: int, channels: int, stream: bool) -> list:
+    """
+    Creates the schema in a fresh database and enables every channel, returning (guild_id, channel_id) pairs.
+    """
+    import aiosqlite
+    from helpers import migrations
+
+    pairs = [(guild_id, guild_id * 1000 + i) for guild_id in range(1, guilds + 1) for i in range(channels)]
+    async with aiosqlite.connect(path) as db:
+        await db.execute("PRAGMA journal_mode=WAL")
+        await migrations.migrate(db)
+        await db.executemany(
+            "INSERT INTO guilds(guild_id, stream) VALUES (?, ?)",
+            [(str(guild_id), int(stream)) for guild_id in range(1, guilds + 1)],
+        )
+        await db.executemany(
+            "INSERT INTO guild_channels(guild_id, channel_id) VALUES (?, ?)",
+            [(str(guild_id), str(channel_id)) for guild_id, channel_id in pairs],
+        )
+        await db.commit()
+    return pairs
+
+
+async def run(args) -> dict:
+    stub = StubOpenAI(args.latency, args.jitter, args.error_rate, args.moderation_latency)
+    # must be set before oai_helper is imported, it reads the API base once
+    os.environ["OPENAI_API_BASE"] = await stub.start()
+
+    from cogs.chat import Chat
+    from helpers import db_manager, http_client, metrics, oai_helper
+
+    workdir = tempfile.mkdtemp(prefix="osiris-bench-")
+    db_manager.DATABASE_PATH = os.path.join(workdir, "database.db")
+    pairs = await setup_database(db_manager.DATABASE_PATH, args.guilds, args.channels, args.stream)
+
+    await db_manager.connect(readers=args.readers)
+    await http_client.start(limit=args.connections, limit_per_host=args.connections)
+    oai_helper.configure_keys("sk-benchmark")
+    await db_manager.load_channels()
+    await db_manager.load_guild_settings()
+
+    # no place-in-line notices, so the first message after a question is always the reply or an error
+    config = {"prefix": "!", "reply_debounce_ms": 0, "reply_workers": args.workers, "reply_queue_size": args.queue_size, "reply_deadline": REPLY_TIMEOUT, "reply_queue_notice": float("inf")}
+    bot = FakeBot(config, send_latency=args.send_latency)
+    cog = Chat(bot)
+    await cog.cog_load()
+    users = [FakeUser(f"user{i}") for i in range(8)]
+    waiters = {}
+    latencies = []
+    failures = 0
+
+    async def on_send(message):
+        # Discord echoes the bot's own messages back to it
+        await cog.on_message(message)
+        waiter = waiters.pop(message.channel.id, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(bool(message.embeds))
+
+    async def drive(guild_id: int, channel_id: int) -> None:
+        nonlocal failures
+        channel = FakeChannel(bot, FakeGuild(guild_id), channel_id, on_send)
+        for i in range(args.messages):
+            message = FakeMessage(channel, users[i % len(users)], f"Question number {i} in channel {channel_id}, what do you think?")
+            channel.messages.append(message)
+            waiter = waiters[channel_id] = asyncio.get_running_loop().create_future()
+            started = time.perf_counter()
+            await cog.on_message(message)
+            try:
+                errored = await asyncio.wait_for(waiter, REPLY_TIMEOUT)
+            except asyncio.TimeoutError:
+                errored = True
+            if errored:
+                failures += 1
+            else:
+                latencies.append(time.perf_counter() - started)
+            # let a streamed or multi-part reply finish before the next message
+            idle_by = time.perf_counter() + REPLY_TIMEOUT
+            while (channel_id in cog.timers or channel_id in cog.replies) and time.perf_counter() < idle_by:
+                await asyncio.sleep(0.005)
+
+    db_before = metrics.DB_SECONDS.totals()
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(drive(guild_id, channel_id) for guild_id, channel_id in pairs))
+        elapsed = time.perf_counter() - started
+    finally:
+        await cog.cog_unload()
+        await http_client.close()
+        await db_manager.close()
+        await stub.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    db_time = {}
+    for (helper,), (count, total) in metrics.DB_SECONDS.totals().items():
+        before_count, before_total = db_before.get((helper,), (0, 0.0))
+        if count > before_count:
+            db_time[helper] = {"calls": count - before_count, "seconds": round(total - before_total, 6), "mean_ms": round((total - before_total) / (count - before_count) * 1000, 4)}
+
+    sent = len(pairs) * args.messages
+    return {
+        "scenario": {"guilds": args.guilds, "channels": args.channels, "messages": args.messages, "stream": args.stream, "latency": args.latency, "error_rate": args.error_rate, "workers": args.workers, "queue_size": args.queue_size},
+        "messages": sent,
+        "replies": len(latencies),
+        "failures": failures,
+        "seconds": round(elapsed, 3),
+        "replies_per_second": round(len(latencies) / elapsed, 2),
+        "latency": {
+            "p50": round(percentile(latencies, 0.50), 4),
+            "p95": round(percentile(latencies, 0.95), 4),
+            "p99": round(percentile(latencies, 0.99), 4),
+            "mean": round(statistics.fmean(latencies), 4) if latencies else 0.0,
+        },
+        "upstream_requests": stub.requests,
+        "db": dict(sorted(db_time.items(), key=lambda item: -item[1]["seconds"])),
+    }
+
+
+def print_report(result: dict) -> None:
+    scenario = result["scenario"]
+    print(f"{scenario['guilds']} guilds x {scenario['channels']} channels x {scenario['messages']} messages, stream={scenario['stream']}")
+    print(f"  {result['messages']} messages in {result['seconds']}s: {result['replies_per_second']} replies/s, {result['failures']} failed")
+    latency = result["latency"]
+    print(f"  reply latency p50 {latency['p50'] * 1000:.1f}ms, p95 {latency['p95'] * 1000:.1f}ms, p99 {latency['p99'] * 1000:.1f}ms")
+    print(f"  upstream requests: {result['upstream_requests']}")
+    print("  database time by helper:")
+    for helper, stats in result["db"].items():
+        print(f"    {helper:<28} {stats['calls']:>8} calls {stats['seconds']:>10.4f}s {stats['mean_ms']:>9.4f}ms/call")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of the chat cog.")
+    parser.add_argument("--scenario", choices=SCENARIOS, help="Preset sizes for --guilds, --channels and --messages, and matching queue settings.")
+    parser.add_argument("--guilds", type=int, default=1)
+    parser.add_argument("--channels", type=int, default=1, help="Channels per guild.")
+    parser.add_argument("--messages", type=int, default=20, help="Messages per channel.")
+    parser.add_argument("--stream", action="store_true", help="Stream replies.")
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds the stub takes per completion.")
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--moderation-latency", type=float, default=0.02)
+    parser.add_argument("--send-latency", type=float, default=0.0, help="Seconds Discord takes per sent message.")
+    parser.add_argument("--readers", type=int, default=4, help="Database reader connections.")
+    parser.add_argument("--workers", type=int, default=16, help="Inference workers.")
+    parser.add_argument("--queue-size", type=int, default=200, help="Replies that may wait for a worker.")
+    parser.add_argument("--connections", type=int, default=100, help="HTTP connections to the stub.")
+    parser.add_argument("--output", help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+    if args.scenario:
+        # a preset only changes the defaults, sizes given explicitly still win
+        parser.set_defaults(**SCENARIOS[args.scenario])
+        args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print_report(result)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(result, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
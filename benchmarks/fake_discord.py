@@ -0,0 +1,98 @@
+"""
+Minimal stand-ins for the discord.py objects the chat cog touches, so it can be driven without a gateway connection.
+Only the attributes and methods Osiris actually uses are implemented.
+"""
+import asyncio
+import itertools
+import logging
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+
+_ids = itertools.count(1_000_000_000_000_000)
+
+
+class FakeUser:
+    def __init__(self, name: str, bot: bool = False):
+        self.id = next(_ids)
+        self.name = self.display_name = name
+        self.bot = bot
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, FakeUser) and other.id == self.id
+
+    def __hash__(self) -> int:
+        return self.id
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+
+
+class FakeMessage:
+    def __init__(self, channel: "FakeChannel", author: FakeUser, content: str = None, embed=None):
+        self.id = next(_ids)
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content or ""
+        self.embeds = [embed] if embed is not None else []
+        self.attachments = []
+        self.created_at = datetime.now(timezone.utc)
+
+    async def edit(self, content: str = None, **kwargs) -> "FakeMessage":
+        await self.channel.bot.simulate_latency()
+        self.content = content
+        return self
+
+    async def delete(self) -> None:
+        await self.channel.bot.simulate_latency()
+
+
+class FakeChannel:
+    """
+    A text channel that keeps the messages sent to it and calls `on_send` with every message the bot sends.
+    """
+
+    def __init__(self, bot: "FakeBot", guild: FakeGuild, channel_id: int, on_send=None):
+        self.bot = bot
+        self.guild = guild
+        self.id = channel_id
+        self.on_send = on_send
+        self.messages = []
+
+    async def send(self, content: str = None, embed=None, **kwargs) -> FakeMessage:
+        await self.bot.simulate_latency()
+        message = FakeMessage(self, self.bot.user, content, embed)
+        self.messages.append(message)
+        if self.on_send is not None:
+            await self.on_send(message)
+        return message
+
+    async def history(self, limit: int = 100):
+        for message in reversed(self.messages[-limit:]):
+            yield message
+
+    @asynccontextmanager
+    async def typing(self):
+        yield
+
+
+class FakeBot:
+    """
+    The parts of the bot the cogs use: its user, its config and its logger. `send_latency` simulates the time
+    Discord takes to accept a sent or edited message.
+    """
+
+    def __init__(self, config: dict, send_latency: float = 0.0):
+        self.user = FakeUser("Osiris", bot=True)
+        self.config = config
+        self.logger = logging.getLogger("benchmark")
+        self.send_latency = send_latency
+
+    async def simulate_latency(self) -> None:
+        if self.send_latency > 0:
+            await asyncio.sleep(self.send_latency)
+
+    def dispatch(self, event: str, *args) -> None:
+        pass
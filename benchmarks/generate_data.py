@@ -0,0 +1,122 @@
+"""
+Fills a database with synthetic guilds, channels, blacklisted users and logged messages at production-like volumes.
+
+Message counts per guild follow a long-tailed distribution, so a few guilds hold most of the messages like on the
+real bot. The same seed always generates the same data.
+
+    python -m benchmarks.generate_data --path /tmp/osiris.db --guilds 20000 --messages 10000000
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+import aiosqlite
+
+from helpers import migrations
+
+WORDS = (
+    "the be to of and a in that have it for not on with he as you do at this but his by from they we say her she or an "
+    "will my one all would there their what so up out if about who get which go me when make can like time no just him "
+    "know take people into year your good some could them see other than then now look only come its over think also "
+    "back after use two how our work first well way even new want because any these give day most us osiris model "
+    "prompt reply server channel python discord token cache latency question answer help please thanks"
+).split()
+
+BATCH_SIZE = 50000
+
+FIRST_GUILD_ID = 100000000000000000
+
+FIRST_USER_ID = 300000000000000000
+
+
+def channel_ids(guild_id: int, channels: int) -> list:
+    return [channel_id(guild_id, i) for i in range(channels)]
+
+
+def channel_id(guild_id: int, index: int) -> int:
+    return guild_id * 1000 + index
+
+
+def _content(rng: random.Random) -> str:
+    return " ".join(rng.choices(WORDS, k=int(rng.paretovariate(1.5) * 8)))[:4000]
+
+
+async def generate(path: str, guilds: int = 20000, channels: int = 3, messages: int = 1000000, blacklist: int = 5000, users: int = 100000, seed: int = 0) -> dict:
+    """
+    Creates the schema in the database at `path` if needed and adds the synthetic rows, returning how many of each.
+    """
+    rng = random.Random(seed)
+    guild_ids = [FIRST_GUILD_ID + i for i in range(guilds)]
+    # long-tailed activity, so that a few guilds are very busy and most are quiet
+    cum_weights = list(itertools.accumulate(rng.paretovariate(1.1) for _ in guild_ids))
+    end = datetime.utcnow()
+    step = timedelta(days=365) / max(1, messages)
+
+    async with aiosqlite.connect(path) as db:
+        await db.execute("PRAGMA journal_mode=WAL")
+        await migrations.migrate(db)
+        # durability doesn't matter for generated data
+        await db.execute("PRAGMA synchronous=OFF")
+
+        await db.executemany(
+            "INSERT OR IGNORE INTO guilds(guild_id, opt, stream) VALUES (?, ?, ?)",
+            ((str(guild_id), int(rng.random() < 0.9), int(rng.random() < 0.2)) for guild_id in guild_ids),
+        )
+        await db.executemany(
+            "INSERT OR IGNORE INTO guild_channels(guild_id, channel_id) VALUES (?, ?)",
+            ((str(guild_id), str(channel)) for guild_id in guild_ids for channel in channel_ids(guild_id, channels)),
+        )
+        await db.executemany(
+            "INSERT OR IGNORE INTO blacklist(user_id) VALUES (?)",
+            ((str(user_id),) for user_id in rng.sample(range(FIRST_USER_ID, FIRST_USER_ID + users), min(blacklist, users))),
+        )
+        await db.commit()
+
+        created = end - timedelta(days=365)
+        for start in range(0, messages, BATCH_SIZE):
+            count = min(BATCH_SIZE, messages - start)
+            rows = []
+            for guild_id in rng.choices(guild_ids, cum_weights=cum_weights, k=count):
+                created += step
+                rows.append((
+                    str(guild_id),
+                    str(rng.randrange(FIRST_USER_ID, FIRST_USER_ID + users)),
+                    str(channel_id(guild_id, rng.randrange(channels))),
+                    _content(rng),
+                    created.strftime("%Y-%m-%d %H:%M:%S"),
+                ))
+            await db.executemany(
+                "INSERT INTO messages(guild_id, author_id, channel_id, content, created_at) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            await db.commit()
+        await db.execute("PRAGMA optimize")
+
+    return {"guilds": guilds, "channels": guilds * channels, "blacklist": min(blacklist, users), "messages": messages}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Generate a synthetic Osiris database.")
+    parser.add_argument("--path", required=True, help="The database file to fill, created if it doesn't exist.")
+    parser.add_argument("--guilds", type=int, default=20000)
+    parser.add_argument("--channels", type=int, default=3, help="Enabled channels per guild.")
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--blacklist", type=int, default=5000, help="Blacklisted users.")
+    parser.add_argument("--users", type=int, default=100000, help="Distinct message authors.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if not 1 <= args.channels < 1000:
+        parser.error("--channels must be between 1 and 999.")
+
+    started = time.perf_counter()
+    counts = asyncio.run(generate(args.path, args.guilds, args.channels, args.messages, args.blacklist, args.users, args.seed))
+    size = os.path.getsize(args.path) / 1024 / 1024
+    print(f"Generated {counts} in {time.perf_counter() - started:.1f}s, {args.path} is {size:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
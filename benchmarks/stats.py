@@ -0,0 +1,20 @@
+import statistics
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(latencies: list) -> dict:
+    """
+    Returns the p50/p95/p99 and mean of the latencies, in milliseconds.
+    """
+    return {
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 4),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 4),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 4),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 4) if latencies else 0.0,
+    }
@@ -0,0 +1,185 @@
+"""
+Times the database helpers of `helpers/db_manager.py` one by one and under concurrent load.
+
+Runs against a copy of a database made by `benchmarks.generate_data`, or against a freshly generated small one,
+so the helpers that write (add_message, opt_out, the blacklist) never touch the original. Results can be saved as
+JSON and compared with an earlier run to catch regressions.
+
+    python -m benchmarks.generate_data --path /tmp/osiris.db --messages 10000000
+    python -m benchmarks.storage --database /tmp/osiris.db --output after.json --compare before.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from benchmarks import generate_data
+from benchmarks.stats import summarize
+from helpers import db_manager
+
+
+class Case:
+    """
+    One helper to benchmark. `run` performs a single call, `finish` (if any) runs once after the calls and is
+    included in the total time, and heavy cases are called fewer times.
+    """
+
+    def __init__(self, name: str, run, finish=None, heavy: bool = False):
+        self.name = name
+        self.run = run
+        self.finish = finish
+        self.heavy = heavy
+
+
+def build_cases(guild_ids: list, blacklisted: list, rng: random.Random) -> list:
+    # opt_out deletes a guild's messages, so every call gets a guild of its own
+    opt_out_guilds = guild_ids[:]
+    rng.shuffle(opt_out_guilds)
+    next_user = iter(range(generate_data.FIRST_USER_ID * 2, generate_data.FIRST_USER_ID * 3))
+
+    async def blacklist_update():
+        user_id = next(next_user)
+        await db_manager.add_user_to_blacklist(user_id)
+        await db_manager.remove_user_from_blacklist(user_id)
+
+    async def iter_messages():
+        async for _ in db_manager.iter_messages(rng.choice(guild_ids)):
+            pass
+
+    def random_user() -> int:
+        return rng.choice(blacklisted) if rng.random() < 0.5 else rng.randrange(generate_data.FIRST_USER_ID, generate_data.FIRST_USER_ID * 2)
+
+    return [
+        Case("is_blacklisted", lambda: db_manager.is_blacklisted(random_user())),
+        Case("is_channel_enabled", lambda: db_manager.is_channel_enabled(generate_data.channel_id(rng.choice(guild_ids), 0))),
+        Case("get_guild_settings", lambda: db_manager.get_guild_settings(rng.choice(guild_ids))),
+        Case("get_channels", lambda: db_manager.get_channels(rng.choice(guild_ids))),
+        Case("get_opt", lambda: db_manager.get_opt(rng.choice(guild_ids))),
+        Case(
+            "add_message",
+            lambda: db_manager.add_message(rng.choice(guild_ids), rng.randrange(10 ** 17, 10 ** 18), rng.choice(guild_ids), "A benchmark message."),
+            finish=db_manager.flush_messages,
+        ),
+        Case("blacklist_update", blacklist_update),
+        Case("get_messages", lambda: db_manager.get_messages(rng.choice(guild_ids)), heavy=True),
+        Case("iter_messages", iter_messages, heavy=True),
+        Case("opt_out", lambda: db_manager.opt_out(opt_out_guilds.pop()), heavy=True),
+    ]
+
+
+async def measure(case: Case, calls: int, concurrency: int) -> dict:
+    latencies = []
+    remaining = iter(range(calls))
+
+    async def worker():
+        for _ in remaining:
+            started = time.perf_counter()
+            await case.run()
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    if case.finish is not None:
+        await case.finish()
+    elapsed = time.perf_counter() - started
+    return {
+        "case": case.name,
+        "concurrency": concurrency,
+        "calls": calls,
+        "seconds": round(elapsed, 6),
+        "ops_per_second": round(calls / elapsed, 2),
+        **summarize(latencies),
+    }
+
+
+def count_rows(path: str) -> dict:
+    with sqlite3.connect(path) as db:
+        return {table: db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in ("guilds", "guild_channels", "blacklist", "messages")}
+
+
+async def run(args, path: str) -> dict:
+    rng = random.Random(args.seed)
+    with sqlite3.connect(path) as db:
+        guild_ids = [int(row[0]) for row in db.execute("SELECT guild_id FROM guilds")]
+        blacklisted = [int(row[0]) for row in db.execute("SELECT user_id FROM blacklist")] or [0]
+
+    db_manager.DATABASE_PATH = path
+    await db_manager.connect(readers=args.readers)
+    results = []
+    try:
+        await db_manager.load_blacklist()
+        await db_manager.load_channels()
+        await db_manager.load_guild_settings()
+        for case in build_cases(guild_ids, blacklisted, rng):
+            if args.cases and case.name not in args.cases:
+                continue
+            for concurrency in args.concurrency:
+                calls = args.heavy_calls if case.heavy else args.calls
+                if case.name == "opt_out":
+                    calls = min(calls, len(guild_ids) // (len(args.concurrency) + 1))
+                result = await measure(case, calls, concurrency)
+                results.append(result)
+                print(f"{result['case']:<20} x{concurrency:<4} {result['ops_per_second']:>12.1f} ops/s  p50 {result['p50_ms']:>9.3f}ms  p95 {result['p95_ms']:>9.3f}ms  p99 {result['p99_ms']:>9.3f}ms")
+    finally:
+        await db_manager.close()
+    return {
+        "environment": {"python": platform.python_version(), "sqlite": sqlite3.sqlite_version, "machine": platform.machine(), "readers": args.readers},
+        "rows": count_rows(path),
+        "results": results,
+    }
+
+
+def compare(results: list, baseline: dict) -> None:
+    previous = {(result["case"], result["concurrency"]): result for result in baseline["results"]}
+    print("\nChange in throughput against the baseline:")
+    for result in results:
+        before = previous.get((result["case"], result["concurrency"]))
+        if before is None or not before["ops_per_second"]:
+            continue
+        change = (result["ops_per_second"] / before["ops_per_second"] - 1) * 100
+        print(f"{result['case']:<20} x{result['concurrency']:<4} {change:>+8.1f}%  (p95 {before['p95_ms']:.3f}ms -> {result['p95_ms']:.3f}ms)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the database helpers.")
+    parser.add_argument("--database", help="A database made by benchmarks.generate_data. A small one is generated if omitted.")
+    parser.add_argument("--calls", type=int, default=2000, help="Calls per case and concurrency level.")
+    parser.add_argument("--heavy-calls", type=int, default=50, help="Calls for the helpers that read or delete a whole guild's messages.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 16, 64], help="Concurrent callers to test with.")
+    parser.add_argument("--cases", nargs="+", help="Only run these cases.")
+    parser.add_argument("--readers", type=int, default=4, help="Database reader connections.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="A JSON file from an earlier run to compare with.")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="osiris-storage-")
+    path = os.path.join(workdir, "database.db")
+    try:
+        if args.database:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(args.database + suffix):
+                    shutil.copyfile(args.database + suffix, path + suffix)
+        else:
+            print("Generating a small database, use benchmarks.generate_data for realistic volumes...")
+            asyncio.run(generate_data.generate(path, guilds=2000, messages=200000, seed=args.seed))
+        result = asyncio.run(run(args, path))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(result, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            compare(result["results"], json.load(file))
+
+
+if __name__ == "__main__":
+    main()
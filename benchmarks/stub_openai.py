@@ -0,0 +1,115 @@
+"""
+An in-process stand-in for the OpenAI API, serving `chat/completions` (plain and streamed) and `moderations` with
+configurable latency and error rates. Point Osiris at it with `OPENAI_API_BASE=http://host:port/v1`.
+
+Run it on its own with `python -m benchmarks.stub_openai --port 8089`.
+"""
+import argparse
+import asyncio
+import json
+import random
+
+from aiohttp import web
+
+REPLY = "This is a canned reply from the stub OpenAI server, long enough to span a few streamed chunks. " * 3
+
+
+class StubOpenAI:
+    """
+    Answers every request after `latency` seconds, give or take `jitter`, and fails a request with a 500 or a 429
+    with probability `error_rate`. Streamed replies are sent in `chunks` pieces spread over the latency.
+    """
+
+    def __init__(self, latency: float = 0.5, jitter: float = 0.1, error_rate: float = 0.0, moderation_latency: float = 0.05, chunks: int = 8):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.moderation_latency = moderation_latency
+        self.chunks = max(1, chunks)
+        self.requests = {"chat/completions": 0, "moderations": 0}
+        self.errors = 0
+        self._runner = None
+
+    def _delay(self, latency: float) -> float:
+        return max(0.0, random.uniform(latency - self.jitter, latency + self.jitter))
+
+    def _error(self):
+        if self.error_rate <= 0 or random.random() >= self.error_rate:
+            return None
+        self.errors += 1
+        if random.random() < 0.5:
+            return web.json_response({"error": {"message": "Rate limited by the stub."}}, status=429, headers={"retry-after": "0.1"})
+        return web.json_response({"error": {"message": "Failed by the stub."}}, status=500)
+
+    async def _completions(self, request: web.Request) -> web.StreamResponse:
+        self.requests["chat/completions"] += 1
+        payload = await request.json()
+        delay = self._delay(self.latency)
+        error = self._error()
+        if error is not None:
+            await asyncio.sleep(delay / self.chunks)
+            return error
+        if not payload.get("stream"):
+            await asyncio.sleep(delay)
+            return web.json_response({"choices": [{"index": 0, "message": {"role": "assistant", "content": REPLY}, "finish_reason": "stop"}]})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        size = -(-len(REPLY) // self.chunks)
+        for i in range(0, len(REPLY), size):
+            await asyncio.sleep(delay / self.chunks)
+            chunk = {"choices": [{"index": 0, "delta": {"content": REPLY[i:i + size]}}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def _moderations(self, request: web.Request) -> web.Response:
+        self.requests["moderations"] += 1
+        payload = await request.json()
+        inputs = payload["input"] if isinstance(payload["input"], list) else [payload["input"]]
+        await asyncio.sleep(self._delay(self.moderation_latency))
+        return web.json_response({"results": [{"flagged": False} for _ in inputs]})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """
+        Starts serving and returns the API base URL. A port of 0 picks a free one.
+        """
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._completions)
+        app.router.add_post("/v1/moderations", self._moderations)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}/v1"
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def main(args) -> None:
+    stub = StubOpenAI(args.latency, args.jitter, args.error_rate, args.moderation_latency, args.chunks)
+    print(f"Serving the stub OpenAI API at {await stub.start(args.host, args.port)}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await stub.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stub OpenAI-compatible API for benchmarks.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds per completion.")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Random variation of the latency, in seconds.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of completions that fail.")
+    parser.add_argument("--moderation-latency", type=float, default=0.05, help="Seconds per moderation request.")
+    parser.add_argument("--chunks", type=int, default=8, help="Pieces per streamed reply.")
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -1,11 +1,12 @@
 import asyncio
-import json
 import logging
 import os
 import platform
 import random
+import signal
 import sys
-from helpers import db_manager
+from helpers import attachments, completion_cache, db_manager, http_client, metrics, migrations, oai_helper, tokens
+from helpers.config import Config
 
 import aiosqlite
 import discord
@@ -17,12 +18,22 @@ import exceptions
 if not os.path.isfile(f"{os.path.realpath(os.path.dirname(__file__))}/config.json"):
     sys.exit("'config.json' not found! Please add it and try again.")
 else:
-    with open(f"{os.path.realpath(os.path.dirname(__file__))}/config.json") as file:
-        config = json.load(file)
+    try:
+        config = Config(f"{os.path.realpath(os.path.dirname(__file__))}/config.json")
+    except ValueError as e:
+        sys.exit(f"'config.json' is invalid: {e}")
+
+# set by cluster.py when this process runs a range of shards as part of a cluster
+CLUSTER_ID = os.getenv("OSIRIS_CLUSTER_ID")
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv("OSIRIS_SHARD_IDS", "").split(",") if shard_id]
+SHARD_COUNT = int(os.getenv("OSIRIS_SHARD_COUNT") or 0) or config.get("shard_count")
 
 intents = discord.Intents.default()
 intents.message_content = True
-bot = Bot(command_prefix=commands.when_mentioned_or(config["prefix"]), intents=intents, help_command=None,)
+if SHARD_IDS or config.get("sharding", False):
+    bot = commands.AutoShardedBot(command_prefix=commands.when_mentioned_or(config["prefix"]), intents=intents, help_command=None, shard_ids=SHARD_IDS or None, shard_count=SHARD_COUNT)
+else:
+    bot = Bot(command_prefix=commands.when_mentioned_or(config["prefix"]), intents=intents, help_command=None,)
 
 
 class LoggingFormatter(logging.Formatter):
@@ -38,11 +49,21 @@ class LoggingFormatter(logging.Formatter):
         return formatter.format(record)
 
 
+class ClusterFilter(logging.Filter):
+    """Tags every record with the cluster it was logged in, so the logs of several processes can be told apart."""
+
+    def filter(self, record):
+        record.name = f"{record.name}[cluster {CLUSTER_ID}]"
+        return True
+
+
 logger = logging.getLogger("discord_bot")
 logger.setLevel(logging.INFO)
+if CLUSTER_ID is not None:
+    logger.addFilter(ClusterFilter())
 console_handler = logging.StreamHandler()
 console_handler.setFormatter(LoggingFormatter())
-file_handler = logging.FileHandler(filename="discord.log", encoding="utf-8", mode="w")
+file_handler = logging.FileHandler(filename="discord.log" if CLUSTER_ID is None else f"discord-cluster{CLUSTER_ID}.log", encoding="utf-8", mode="w")
 file_handler_formatter = logging.Formatter("[{asctime}] [{levelname:<8}] {name}: {message}", "%Y-%m-%d %H:%M:%S", style="{")
 file_handler.setFormatter(file_handler_formatter)
 logger.addHandler(console_handler)
@@ -52,11 +73,12 @@ bot.logger = logger
 
 async def init_db():
     async with aiosqlite.connect(f"{os.path.realpath(os.path.dirname(__file__))}/database/database.db") as db:
-        with open(f"{os.path.realpath(os.path.dirname(__file__))}/database/schema.sql") as file:
-            await db.executescript(file.read())
-        await db.commit()
+        await db.execute("PRAGMA journal_mode=WAL")
+        for version in await migrations.migrate(db):
+            bot.logger.info(f"Applied database migration {version}")
 
 bot.config = config
+bot.started = False
 
 
 @bot.event
@@ -65,34 +87,89 @@ async def on_ready():
     bot.logger.info(f"discord.py API version: {discord.__version__}")
     bot.logger.info(f"Python version: {platform.python_version()}")
     bot.logger.info(f"Running on: {platform.system()} {platform.release()} ({os.name})")
+    if isinstance(bot, commands.AutoShardedBot):
+        bot.logger.info(f"Running shards {sorted(bot.shards)} of {bot.shard_count}")
     bot.logger.info("-------------------")
-    status_task.start()
+    if not status_task.is_running():
+        status_task.start()
+    if not config_watch_task.is_running():
+        config_watch_task.start()
+    if CLUSTER_ID is not None and not blacklist_sync_task.is_running():
+        blacklist_sync_task.start()
+    # on_ready fires again after every reconnect, the rest only needs to happen once
+    if bot.started:
+        return
+    bot.started = True
     if config["sync_commands_globally"]:
         bot.logger.info("Syncing commands globally...")
         await bot.tree.sync()
-    for guild in bot.guilds:
-        try:
-            if not await db_manager.is_guild_in_db(guild.id):
-                try:
-                    await db_manager.add_guild(guild.id)
-                    bot.logger.info(f"Added guild {guild.name} (ID: {guild.id}) to the database.")
-                except Exception as e:
-                    bot.logger.error(f"Failed to add guild {guild.name} (ID: {guild.id}) to the database: {type(e).__name__}: {e}")
-            else:
-                bot.logger.info(f"Guild {guild.name} (ID: {guild.id}) is already in the database.")
-        except Exception as e:
-            bot.logger.error(f"Failed to check if guild {guild.name} (ID: {guild.id}) is in the database: {type(e).__name__}: {e}")
+    try:
+        added = await db_manager.add_guilds([guild.id for guild in bot.guilds])
+        bot.logger.info(f"Added {added} of {len(bot.guilds)} guilds to the database.")
+    except Exception as e:
+        bot.logger.error(f"Failed to add the guilds to the database: {type(e).__name__}: {e}")
+    try:
+        bot.logger.info(f"Loaded the settings of {await db_manager.load_guild_settings()} guilds into memory.")
+    except Exception as e:
+        bot.logger.error(f"Failed to load guild settings: {type(e).__name__}: {e}")
 
 @tasks.loop(minutes=1.0)
 async def status_task():
     statuses = ["with your mind", "games with you", "with your heart", "with your soul"]
-    await bot.change_presence(activity=discord.Game(random.choice(statuses)))
+    if isinstance(bot, commands.AutoShardedBot):
+        for shard_id, shard in bot.shards.items():
+            if not shard.is_closed():
+                await bot.change_presence(activity=discord.Game(f"{random.choice(statuses)} | shard {shard_id}"), shard_id=shard_id)
+    else:
+        await bot.change_presence(activity=discord.Game(random.choice(statuses)))
+
+
+@tasks.loop(minutes=1.0)
+async def blacklist_sync_task():
+    # other clusters may have changed the blacklist, which every process keeps in memory
+    try:
+        await db_manager.load_blacklist()
+    except Exception as e:
+        bot.logger.error(f"Failed to reload the blacklist: {type(e).__name__}: {e}")
+
+
+@bot.event
+async def on_shard_ready(shard_id: int):
+    bot.logger.info(f"Shard {shard_id} is ready.")
+
+
+@bot.event
+async def on_shard_disconnect(shard_id: int):
+    bot.logger.warning(f"Shard {shard_id} disconnected.")
+
+
+@bot.event
+async def on_shard_resumed(shard_id: int):
+    bot.logger.info(f"Shard {shard_id} resumed its session.")
+
+
+@tasks.loop(seconds=30.0)
+async def config_watch_task():
+    try:
+        if config.reload_if_changed():
+            bot.dispatch("config_reload")
+    except Exception as e:
+        bot.logger.error(f"Failed to reload the config: {type(e).__name__}: {e}")
+
+
+@bot.event
+async def on_config_reload():
+    bot.command_prefix = commands.when_mentioned_or(config["prefix"])
+    oai_helper.configure_keys(config["openai_api_key"])
+    bot.logger.info("Reloaded the config.")
 
 
 @bot.event
 async def on_message(message: discord.Message):
     if message.author == bot.user or message.author.bot:
         return
+    if await db_manager.is_blacklisted(message.author.id):
+        return
     await bot.process_commands(message)
 
 
@@ -162,10 +239,64 @@ async def load_cogs() -> None:
 
 async def run():
     await init_db()
-    await load_cogs()
-    await bot.start(config["token"])
+    await db_manager.connect(
+        readers=config.get("database_readers", 4),
+        log_batch_size=config.get("message_log_batch_size", 500),
+        log_flush_interval=config.get("message_log_flush_ms", 250) / 1000,
+        verdict_retention_days=config.get("moderation_cache_retention_days", 30),
+    )
+    await http_client.start(
+        limit=config.get("http_connection_limit", 100),
+        limit_per_host=config.get("http_connection_limit_per_host", 20),
+        timeout=config.get("http_timeout", 120),
+        stream_read_timeout=config.get("http_stream_read_timeout", 60),
+    )
+    oai_helper.configure_keys(config["openai_api_key"])
+    oai_helper.configure_resilience(
+        retries=config.get("upstream_retries", 2),
+        deadline=config.get("upstream_deadline", 90),
+        hedge_after=config.get("upstream_hedge_after"),
+        failure_threshold=config.get("circuit_breaker_threshold", 5),
+        recovery_time=config.get("circuit_breaker_recovery", 30),
+    )
+    oai_helper.configure_moderation(
+        cache_size=config.get("moderation_cache_size", 10000),
+        persist=config.get("moderation_cache_persist", True),
+    )
+    completion_cache.configure(
+        size=config.get("completion_cache_size", 0),
+        ttl=config.get("completion_cache_ttl", 3600),
+        persist=config.get("completion_cache_persist", False),
+    )
+    attachments.configure(max_bytes=config.get("attachment_cache_bytes", 32 * 1024 * 1024))
+    if not await asyncio.to_thread(tokens.load):
+        bot.logger.warning("tiktoken or its bundled encodings are not available, some token counts will be estimated.")
+    try:
+        if config.get("metrics_port", 9464) is not None:
+            # every cluster serves its own metrics, on the next port up
+            metrics_port = config.get("metrics_port", 9464) + int(CLUSTER_ID or 0)
+            try:
+                await metrics.start(config.get("metrics_host", "127.0.0.1"), metrics_port)
+                bot.logger.info(f"Serving metrics on http://{config.get('metrics_host', '127.0.0.1')}:{metrics_port}/metrics")
+            except OSError as e:
+                # metrics are optional, the bot runs without them, e.g. when another process has the port
+                bot.logger.error(f"Failed to serve metrics on port {metrics_port}: {e}")
+        bot.logger.info(f"Loaded {await db_manager.load_blacklist()} blacklisted users into memory.")
+        bot.logger.info(f"Loaded {await db_manager.load_channels()} channels into memory.")
+        await load_cogs()
+        # Ctrl+C and cluster.py's SIGTERM close the bot cleanly, so queued writes are flushed below
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                asyncio.get_running_loop().add_signal_handler(signum, lambda: asyncio.ensure_future(bot.close()))
+            except NotImplementedError:
+                pass
+        await bot.start(config["token"])
+    finally:
+        await metrics.close()
+        await http_client.close()
+        await db_manager.close()
 
 
 if __name__ == "__main__":
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(run())
+    # asyncio.run cancels run() on an early Ctrl+C, so its cleanup still runs
+    asyncio.run(run())
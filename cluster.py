@@ -0,0 +1,136 @@
+"""
+Runs Osiris as a cluster of processes, each connected to Discord with its own range of shards.
+
+The shards are split evenly over `clusters` processes, and each process runs `bot.py` as an AutoShardedBot with
+its range. A process that exits is restarted with backoff. Start it instead of `bot.py` with `python cluster.py`.
+"""
+import asyncio
+import logging
+import os
+import signal
+import sys
+import time
+
+import aiohttp
+import aiosqlite
+
+from helpers import migrations
+from helpers.config import Config
+
+ROOT = os.path.realpath(os.path.dirname(__file__))
+
+DATABASE_PATH = f"{ROOT}/database/database.db"
+
+# Discord allows one IDENTIFY per 5 seconds per bucket, so clusters start one after the other
+IDENTIFY_INTERVAL = 5.0
+
+RESTART_BACKOFF_MAX = 300.0
+
+logger = logging.getLogger("cluster")
+
+
+def split_shards(shard_count: int, clusters: int) -> list:
+    """
+    Returns the shard IDs of each cluster, as contiguous ranges that differ in size by at most one.
+    """
+    clusters = max(1, min(clusters, shard_count))
+    size, extra = divmod(shard_count, clusters)
+    ranges, start = [], 0
+    for cluster_id in range(clusters):
+        end = start + size + (1 if cluster_id < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+async def recommended_shard_count(token: str) -> int:
+    """
+    Asks Discord how many shards the bot should use.
+    """
+    async with aiohttp.ClientSession() as session:
+        async with session.get("https://discord.com/api/v10/gateway/bot", headers={"Authorization": f"Bot {token}"}) as response:
+            response.raise_for_status()
+            return (await response.json())["shards"]
+
+
+async def migrate() -> None:
+    # migrations run once here, before any cluster opens the database
+    async with aiosqlite.connect(DATABASE_PATH) as db:
+        await db.execute("PRAGMA journal_mode=WAL")
+        for version in await migrations.migrate(db):
+            logger.info(f"Applied database migration {version}")
+
+
+class Cluster:
+    """
+    One `bot.py` process and the shards it runs.
+    """
+
+    def __init__(self, cluster_id: int, shard_ids: list, shard_count: int):
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.process = None
+        self.stopping = False
+        self._stopped = asyncio.Event()
+
+    async def _sleep(self, seconds: float) -> None:
+        try:
+            await asyncio.wait_for(self._stopped.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self, delay: float) -> None:
+        """
+        Starts the process after `delay` seconds and restarts it whenever it exits, until stopped.
+        """
+        await self._sleep(delay)
+        backoff = IDENTIFY_INTERVAL
+        while not self.stopping:
+            env = dict(
+                os.environ,
+                OSIRIS_CLUSTER_ID=str(self.cluster_id),
+                OSIRIS_SHARD_IDS=",".join(map(str, self.shard_ids)),
+                OSIRIS_SHARD_COUNT=str(self.shard_count),
+            )
+            started = time.monotonic()
+            self.process = await asyncio.create_subprocess_exec(sys.executable, f"{ROOT}/bot.py", cwd=ROOT, env=env)
+            logger.info(f"Started cluster {self.cluster_id} (PID {self.process.pid}) with shards {self.shard_ids[0]}-{self.shard_ids[-1]}")
+            code = await self.process.wait()
+            if self.stopping:
+                break
+            # a cluster that ran for a while before exiting gets restarted quickly again
+            if time.monotonic() - started > RESTART_BACKOFF_MAX:
+                backoff = IDENTIFY_INTERVAL
+            logger.warning(f"Cluster {self.cluster_id} exited with code {code}, restarting in {backoff:.0f} seconds")
+            await self._sleep(backoff)
+            backoff = min(backoff * 2, RESTART_BACKOFF_MAX)
+
+    def stop(self) -> None:
+        self.stopping = True
+        self._stopped.set()
+        if self.process is not None and self.process.returncode is None:
+            self.process.terminate()
+
+
+async def main() -> None:
+    config = Config(f"{ROOT}/config.json")
+    await migrate()
+
+    shard_count = config.get("shard_count") or await recommended_shard_count(config["token"])
+    clusters = [Cluster(cluster_id, shard_ids, shard_count) for cluster_id, shard_ids in enumerate(split_shards(shard_count, config.get("clusters", 1)))]
+    logger.info(f"Running {shard_count} shards in {len(clusters)} clusters")
+
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, lambda: [cluster.stop() for cluster in clusters])
+
+    delays = [0.0]
+    for cluster in clusters[:-1]:
+        delays.append(delays[-1] + IDENTIFY_INTERVAL * len(cluster.shard_ids))
+    await asyncio.gather(*(cluster.run(delay) for cluster, delay in zip(clusters, delays)))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[{asctime}] [{levelname:<8}] {name}: {message}", datefmt="%Y-%m-%d %H:%M:%S", style="{")
+    asyncio.run(main())
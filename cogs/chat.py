@@ -1,94 +1,266 @@
 from discord.ext import commands
-from helpers import db_manager, oai_helper
+from helpers import context, db_manager, metrics, oai_helper
+from helpers.job_queue import Job, JobQueue, QueueFull
 from discord import channel, Embed
-import re, json, os, random
+from collections import deque
+import asyncio
+import time
+
+STREAM_EDIT_INTERVAL = 1.2
+CONTEXT_SIZE = 50
+NEW_CONVERSATION_MESSAGE = "New conversation started!"
+BUSY_MESSAGE = "Osiris is busy right now, please try again in a moment."
+
+def _split_message(text: str) -> list:
+    return [text[i:i+2000] for i in range(0, len(text), 2000)]
 
 class Chat(commands.Cog, name="chat"):
     def __init__(self, bot):
         self.bot = bot
+        self.conversations = {}
+        self.timers = {}
+        self.replies = {}
+        self.sending = set()
+        self.jobs = None
+
+    async def cog_load(self):
+        self.jobs = JobQueue(
+            "replies",
+            workers=self.bot.config.get("reply_workers", 16),
+            max_pending=self.bot.config.get("reply_queue_size", 200),
+        )
+        self.jobs.start()
+
+    async def cog_unload(self):
+        for timer in self.timers.values():
+            timer.cancel()
+        if self.jobs is not None:
+            await self.jobs.close()
 
     @commands.Cog.listener()
+    @metrics.timed(metrics.ON_MESSAGE_SECONDS)
     async def on_message(self, message):
         """Respond to messages."""
 
-        if message.author == self.bot.user or message.guild is None or isinstance(message.channel, channel.DMChannel):
+        if message.guild is None or isinstance(message.channel, channel.DMChannel):
             return
 
-        selected_channel_ids = await db_manager.get_channels(str(message.guild.id))
-        if str(message.channel.id) not in selected_channel_ids:
+        if not await db_manager.is_channel_enabled(message.channel.id):
+            self.conversations.pop(message.channel.id, None)
             return
 
-        model = await db_manager.get_model(message.guild.id) or "gpt-3.5-turbo-16k"
-        temp = await db_manager.get_temperature(message.guild.id) or 0.5
-        opt_status = await db_manager.get_opt(message.guild.id) or True
-
-        if opt_status:
-            await db_manager.add_message(message.guild.id, message.author.id, message.channel.id, message.content)
+        if message.author == self.bot.user:
+            self._remember(message)
+            return
 
         if await db_manager.is_blacklisted(message.author.id):
             await message.delete()
             return
 
+        metrics.MESSAGES_TOTAL.inc(guild=message.guild.id)
+        settings = await db_manager.get_guild_settings(message.guild.id)
+        opt_status = settings.opt if settings.opt is not None else True
+
+        if opt_status:
+            await db_manager.add_message(message.guild.id, message.author.id, message.channel.id, message.content)
+
+        self._remember(message)
+
         if message.content.startswith(self.bot.config["prefix"]):
             return
 
-        history = []
-        async for msg in message.channel.history(limit=10):
-            if msg.author == self.bot.user and msg.content == "New conversation started!":
-                break
-            history.append(msg)
-
-        oai_msgs = [{"role": "system", "content": await db_manager.get_instructions(message.guild.id)}]
-        supported_filetypes = ["txt", "log", "py", "js", "json", "html", "css", "md", "csv", "tsv", "xml", "yaml", "yml", "ini", "cfg", "toml", "sh", "bat", "ps1", "psm1", "psd1", "ps1xml", "psc1", "pssc", "reg", "inf", "sql"]
-
-        for msg in reversed(history):
-            role = "user" if msg.author != self.bot.user else "assistant"
-            name = re.sub(r"[^a-zA-Z0-9]", "", msg.author.display_name)
-            user_content = msg.content
-            if msg.attachments:
-                for attachment in msg.attachments:
-                    if attachment.filename.split(".")[-1] in supported_filetypes:
-                        attachment_content = await attachment.read()
-                        attachment_content = attachment_content.decode("utf-8")
-                        if len(attachment_content) > 10000:
-                            attachment_content = attachment_content[:10000]
-                        user_content += "\n\n" + attachment.filename + ":\n```\n" + attachment_content + "\n```"
-            oai_msgs.append({"role": role, "content": user_content, "name": name})
-
-        with open(f"{os.path.realpath(os.path.dirname(__file__))}/../config.json") as file:
-            data = json.load(file)
-
-        if "," in data["openai_api_key"]:
-            API_KEY = data["openai_api_key"].split(",")
-        else:
-            API_KEY = data["openai_api_key"]
-
-
-        API_KEY = random.choice(API_KEY) if isinstance(API_KEY, list) else API_KEY
-
-        async with message.channel.typing():
-            assistant_message = await oai_helper.infer(oai_msgs, model, temp, API_KEY)
-            
-            if isinstance(assistant_message, int):
-                error_embed = Embed(
-                    title="Error!",
-                    description=f"An error occurred while trying to generate a response. Please try again later. Error code {str(assistant_message)}",
-                    color=0xff0000
-                )
-                await message.channel.send(embed=error_embed)
-                return
+        self._schedule_reply(message.channel, settings)
+
+    def _schedule_reply(self, channel, settings):
+        """
+        Queues a reply in the channel once nobody has written in it for `reply_debounce_ms`, so a burst of messages
+        gets a single reply. A reply that is still queued will read the new message when it starts, so it is kept.
+        One that is generating is cancelled, as the new message supersedes it. One that has started sending is left
+        to finish.
+        """
+        job = self.replies.get(channel.id)
+        if job is not None and job.state == Job.WAITING:
+            return
+        self._cancel_reply(channel.id)
+        delay = self.bot.config.get("reply_debounce_ms", 750) / 1000
+        self.timers[channel.id] = asyncio.get_running_loop().call_later(delay, self._enqueue_reply, channel, settings, time.monotonic())
+
+    def _cancel_reply(self, channel_id):
+        timer = self.timers.pop(channel_id, None)
+        if timer is not None:
+            timer.cancel()
+        job = self.replies.get(channel_id)
+        if job is not None and job.task not in self.sending:
+            job.cancel()
+
+    def _enqueue_reply(self, channel, settings, started):
+        """
+        Hands the reply to the inference workers. When the queue is full the channel is told to try again later,
+        and when the reply has to wait behind several others the channel is told its place in line. The deadline
+        only covers waiting and generating, a reply that has started sending is never cut off.
+        """
+        self.timers.pop(channel.id, None)
+        try:
+            # the callbacks only run once the job has started, by which time `job` is set
+            job = self.jobs.submit(
+                lambda: self._reply(channel, settings, started),
+                deadline=self.bot.config.get("reply_deadline", 150),
+                on_timeout=lambda: self._reply_timed_out(channel, job),
+                cancellable=lambda: job.task not in self.sending,
+            )
+        except QueueFull:
+            asyncio.create_task(self._send_notice(channel, BUSY_MESSAGE))
+            return
+        self.replies[channel.id] = job
+        position = self.jobs.position(job)
+        if position >= self.bot.config.get("reply_queue_notice", 5):
+            asyncio.create_task(self._send_notice(channel, f"Osiris is busy, your reply is number {position + 1} in line."))
 
-            if len(assistant_message) > 2000:
-                parts = [assistant_message[i:i+2000] for i in range(0, len(assistant_message), 2000)]
-                for part in parts:
-                    await message.channel.send(part)
+    async def _reply_timed_out(self, channel, job):
+        # a reply dropped while waiting never ran, so it is forgotten here instead of by _reply
+        if self.replies.get(channel.id) is job:
+            del self.replies[channel.id]
+        await self._send_notice(channel, "Osiris took too long to reply, please try again.")
+
+    async def _send_notice(self, channel, text):
+        try:
+            await channel.send(embed=Embed(description=text, color=0xE02B2B))
+        except Exception as e:
+            self.bot.logger.error(f"Failed to send a notice in channel {channel.id}: {type(e).__name__}: {e}")
+
+    async def _reply(self, channel, settings, started):
+        try:
+            model = settings.model or "gpt-3.5-turbo-16k"
+            temp = settings.temperature if settings.temperature is not None else 0.5
+
+            history = await self._get_conversation(channel)
+
+            oai_msgs, moderation_inputs = await context.build(settings.instructions, history, model, self.bot.user)
+
+            async with channel.typing():
+                if settings.stream:
+                    assistant_message = await self._send_streamed(channel, oai_helper.infer_stream(oai_msgs, model, temp, moderation_inputs=moderation_inputs))
+                else:
+                    assistant_message = await oai_helper.infer(oai_msgs, model, temp, moderation_inputs=moderation_inputs)
+                    if not isinstance(assistant_message, int):
+                        self.sending.add(asyncio.current_task())
+                        for part in _split_message(assistant_message):
+                            with metrics.DISCORD_SEND_SECONDS.time():
+                                sent = await channel.send(part)
+                            self._remember(sent)
+
+                if isinstance(assistant_message, int):
+                    metrics.ERRORS_TOTAL.inc(code=assistant_message)
+                    error_embed = Embed(
+                        title="Error!",
+                        description=f"An error occurred while trying to generate a response. Please try again later. Error code {str(assistant_message)}",
+                        color=0xff0000
+                    )
+                    await channel.send(embed=error_embed)
+                    return
+            metrics.REPLY_SECONDS.observe(time.monotonic() - started)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            metrics.ERRORS_TOTAL.inc(code=type(e).__name__)
+            self.bot.logger.error(f"Failed to reply in channel {channel.id}: {type(e).__name__}: {e}")
+        finally:
+            self.sending.discard(asyncio.current_task())
+            job = self.replies.get(channel.id)
+            if job is not None and job.task is asyncio.current_task():
+                del self.replies[channel.id]
+
+    async def _send_streamed(self, channel, stream):
+        """
+        Posts a streamed reply as it is generated, editing it at most once every STREAM_EDIT_INTERVAL seconds and
+        continuing in a new message past Discord's 2000 character limit.
+        Returns the whole reply, or the error status code if generation failed, leaving whatever was already sent.
+        """
+        text = ""
+        sent = []
+        last_update = 0.0
+        async for delta in stream:
+            if isinstance(delta, int):
+                return delta
+            text += delta
+            now = time.monotonic()
+            if not text.strip() or sent and now - last_update < STREAM_EDIT_INTERVAL:
+                continue
+            await self._update_streamed(channel, text, sent)
+            last_update = now
+        if text.strip():
+            await self._update_streamed(channel, text, sent)
+        return text
+
+    async def _update_streamed(self, channel, text, sent):
+        self.sending.add(asyncio.current_task())
+        for i, part in enumerate(_split_message(text)):
+            if i >= len(sent):
+                with metrics.DISCORD_SEND_SECONDS.time():
+                    sent.append([await channel.send(part), part])
+            elif sent[i][1] != part:
+                with metrics.DISCORD_SEND_SECONDS.time():
+                    sent[i] = [await sent[i][0].edit(content=part), part]
             else:
-                await message.channel.send(assistant_message)
+                continue
+            self._remember(sent[i][0])
+
+    def _remember(self, message):
+        """
+        Adds the message to its channel's conversation buffer, replacing the buffered copy if it is already there.
+        The conversation is reset when Osiris announces a new one.
+        """
+        if message.author == self.bot.user and message.content == NEW_CONVERSATION_MESSAGE:
+            self.conversations[message.channel.id] = deque(maxlen=CONTEXT_SIZE)
+            self._cancel_reply(message.channel.id)
+            return
+        conversation = self.conversations.get(message.channel.id)
+        if conversation is None:
+            return
+        for i, msg in enumerate(conversation):
+            if msg.id == message.id:
+                conversation[i] = message
+                return
+        conversation.append(message)
+
+    async def _get_conversation(self, channel):
+        """
+        Returns the buffered conversation of the channel, oldest message first.
+        The buffer is filled from the channel history the first time the channel is seen.
+        """
+        conversation = self.conversations.get(channel.id)
+        if conversation is None:
+            history = []
+            async for msg in channel.history(limit=CONTEXT_SIZE):
+                if msg.author == self.bot.user and msg.content == NEW_CONVERSATION_MESSAGE:
+                    break
+                history.append(msg)
+            conversation = self.conversations[channel.id] = deque(reversed(history), maxlen=CONTEXT_SIZE)
+        return list(conversation)
+
+    @commands.Cog.listener()
+    async def on_message_edit(self, before, after):
+        """Keep edited messages up to date in the conversation buffer."""
+        conversation = self.conversations.get(after.channel.id)
+        if conversation is not None and any(msg.id == after.id for msg in conversation):
+            self._remember(after)
+
+    @commands.Cog.listener()
+    async def on_message_delete(self, message):
+        """Drop deleted messages from the conversation buffer."""
+        conversation = self.conversations.get(message.channel.id)
+        if conversation is not None:
+            for msg in conversation:
+                if msg.id == message.id:
+                    conversation.remove(msg)
+                    break
 
 
     @commands.Cog.listener()
     async def on_guild_join(self, guild):
         """Welcome message when bot joins a guild."""
+        await db_manager.add_guild(guild.id)
+
         message_embed = Embed(
             title="Welcome to Osiris!",
             description="To get started, use the `/osiris channel add` command in the channel you want Osiris to speak in.",
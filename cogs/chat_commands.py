@@ -1,12 +1,35 @@
+import datetime
+import gzip
 import json
-import os
-import asyncio, aiohttp
+import asyncio
+import discord
 from discord.ext import commands
 from discord.ext.commands import Context
 from discord import TextChannel, File, Embed
-from helpers import checks, db_manager
+from helpers import checks, db_manager, oai_helper
 from io import BytesIO
 
+EXPORT_CHUNK_SIZE = 8000000
+EXPORT_BATCH_SIZE = 1000
+
+CLEAN_DEFAULT_DEPTH = 100
+CLEAN_MAX_DEPTH = 5000
+# the most messages Discord deletes in one bulk delete
+CLEAN_PAGE_SIZE = 100
+
+def _encode_export_batch(messages: list, bot_id: str, compress: bool) -> list:
+    """
+    Encodes a batch of messages as JSONL and returns it as pieces no larger than EXPORT_CHUNK_SIZE.
+    Compressed pieces are standalone gzip members, which can be concatenated into a single valid gzip file.
+    """
+    lines = [json.dumps({"role": "assistant" if message["author_id"] == bot_id else "user", "content": message["content"]}) + "\n" for message in messages]
+    data = "".join(lines).encode("utf-8")
+    piece = gzip.compress(data) if compress else data
+    if len(piece) <= EXPORT_CHUNK_SIZE or len(messages) == 1:
+        return [piece]
+    middle = len(messages) // 2
+    return _encode_export_batch(messages[:middle], bot_id, compress) + _encode_export_batch(messages[middle:], bot_id, compress)
+
 class ChatCommands(commands.Cog, name="chat_commands"):
     def __init__(self, bot):
         self.bot = bot
@@ -128,6 +151,47 @@ class ChatCommands(commands.Cog, name="chat_commands"):
         await db_manager.opt_out(context.guild.id)
         await context.send("Opted out of conversation data collection.", ephemeral=True)
 
+    @osiris.group(
+        name="stream",
+        description="Stream Osiris' replies into the channel as they are written.",
+    )
+    @checks.is_server_admin()
+    @checks.not_blacklisted()
+    async def stream(self, context: Context):
+        pass
+
+    @stream.command(
+        name="get",
+        description="Get whether Osiris' replies are streamed in your server.",
+    )
+    @checks.is_server_admin()
+    @checks.not_blacklisted()
+    async def stream_get(self, context: Context):
+        if await db_manager.get_stream(context.guild.id):
+            await context.send("Replies are streamed as they are written.", ephemeral=True)
+        else:
+            await context.send("Replies are sent once they are complete.", ephemeral=True)
+
+    @stream.command(
+        name="on",
+        description="Stream Osiris' replies as they are written.",
+    )
+    @checks.is_server_admin()
+    @checks.not_blacklisted()
+    async def stream_on(self, context: Context):
+        await db_manager.set_stream(context.guild.id, True)
+        await context.send("Replies will now be streamed as they are written.", ephemeral=True)
+
+    @stream.command(
+        name="off",
+        description="Send Osiris' replies once they are complete.",
+    )
+    @checks.is_server_admin()
+    @checks.not_blacklisted()
+    async def stream_off(self, context: Context):
+        await db_manager.set_stream(context.guild.id, False)
+        await context.send("Replies will now be sent once they are complete.", ephemeral=True)
+
     @osiris.group(
         name="model",
         description="Set the model for the server.",
@@ -168,38 +232,34 @@ class ChatCommands(commands.Cog, name="chat_commands"):
     )
     @checks.is_server_admin()
     @checks.not_blacklisted()
-    async def export(self, context: Context):
-        messages = await db_manager.get_messages(context.guild.id)
-        if messages is None:
+    async def export(self, context: Context, compress: bool = False):
+        await context.defer(ephemeral=True)
+        bot_id = str(self.bot.user.id)
+        extension = "jsonl.gz" if compress else "jsonl"
+        chunk = BytesIO()
+        files_sent = 0
+        total_messages = 0
+
+        async def send_chunk():
+            nonlocal chunk, files_sent
+            chunk.seek(0)
+            files_sent += 1
+            await context.send(file=File(chunk, filename=f"messages_{files_sent - 1}.{extension}"), content=f"Here's your conversation data, hot off the press! (part {files_sent})", ephemeral=True)
+            chunk = BytesIO()
+
+        async for batch in db_manager.iter_messages(context.guild.id, batch_size=EXPORT_BATCH_SIZE):
+            total_messages += len(batch)
+            for piece in await asyncio.to_thread(_encode_export_batch, batch, bot_id, compress):
+                if chunk.tell() and chunk.tell() + len(piece) > EXPORT_CHUNK_SIZE:
+                    await send_chunk()
+                chunk.write(piece)
+
+        if total_messages == 0:
             await context.send("No messages to export.", ephemeral=True)
             return
-
-        chunk_size = 8000000
-        bot_id = self.bot.user.id
-        messages_json = []
-        total_size = 0
-        files = []
-
-        for message in messages:
-            role = 'assistant' if message['author_id'] == bot_id else 'user'
-            json_message = json.dumps({"role": role, "content": message['content']})
-            message_size = len(json_message.encode('utf-8'))
-
-            if total_size + message_size > chunk_size:
-                file_content = "\n".join(messages_json)
-                files.append(File(BytesIO(file_content.encode('utf-8')), filename=f"messages_{len(files)}.jsonl"))
-                messages_json = []
-                total_size = 0
-
-            messages_json.append(json_message)
-            total_size += message_size
-
-        if messages_json:
-            file_content = "\n".join(messages_json)
-            files.append(File(BytesIO(file_content.encode('utf-8')), filename=f"messages_{len(files)}.jsonl"))
-
-        for file in files:
-            await context.send(file=file, content=f"Here's your conversation data, hot off the press! ({files.index(file)+1} of {len(files)})", ephemeral=True)
+        if chunk.tell():
+            await send_chunk()
+        await context.send(f"Exported {total_messages} messages in {files_sent} {'file' if files_sent == 1 else 'files'}.", ephemeral=True)
 
     @osiris.group(
         name="temp",
@@ -275,34 +335,46 @@ class ChatCommands(commands.Cog, name="chat_commands"):
     )
     @checks.is_server_admin()
     @checks.not_blacklisted()
-    async def clean(self, context: Context):
-        session = aiohttp.ClientSession()
-        response_msg = await context.send("Cleaning up inappropriate messages...", ephemeral=True)
-        async for msg in context.channel.history(limit=30):
-            # start with a healthy nap
-            await asyncio.sleep(0.25)
-            moderation_url = os.getenv("MODERATION_URL", "https://api.openai.com/v1/moderations")
-            # construct request body
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.bot.config['openai_api_key']}"
-            }
-            data = {
-                "input": msg.content,
-            }
-            # make request
-            async with session.post(moderation_url, headers=headers, data=json.dumps(data)) as response:
-                if response.status == 200:
-                    response = await response.json()
-                    if response['results'][0]['flagged']:
-                        await msg.delete()
-                        await response_msg.edit(content="Cleaned up inappropriate messages.", ephemeral=True)
-                        session.close()
-                        return
-                else:
-                    await context.channel.send("Error occurred while making moderation request.")
-                    session.close()
-                    return
+    async def clean(self, context: Context, depth: int = CLEAN_DEFAULT_DEPTH):
+        if depth < 1 or depth > CLEAN_MAX_DEPTH:
+            await context.send(f"Depth must be between 1 and {CLEAN_MAX_DEPTH}.", ephemeral=True)
+            return
+        await context.defer(ephemeral=True)
+        response_msg = await context.send(f"Cleaning up inappropriate messages in the last {depth} messages...", ephemeral=True)
+        scanned = removed = failed = 0
+        page = []
+        async for msg in context.channel.history(limit=depth):
+            page.append(msg)
+            if len(page) < CLEAN_PAGE_SIZE:
+                continue
+            page_removed, page_failed = await self._clean_page(context.channel, page)
+            scanned, removed, failed = scanned + len(page), removed + page_removed, failed + page_failed
+            page = []
+            await response_msg.edit(content=f"Scanned {scanned}/{depth} messages, removed {removed} so far...")
+        if page:
+            page_removed, page_failed = await self._clean_page(context.channel, page)
+            scanned, removed, failed = scanned + len(page), removed + page_removed, failed + page_failed
+        result = f"Scanned {scanned} messages and removed {removed} inappropriate ones."
+        if failed:
+            result += f" {failed} messages couldn't be moderated, try again later."
+        await response_msg.edit(content=result)
+
+    async def _clean_page(self, channel: TextChannel, messages: list) -> tuple:
+        """
+        Moderates up to 100 messages in batches and deletes the flagged ones. Returns how many were deleted and how
+        many couldn't be moderated.
+        Messages younger than 14 days are deleted in bulk, older ones one by one as Discord requires.
+        """
+        verdicts = await oai_helper.get_verdicts([msg.content for msg in messages])
+        flagged = [msg for msg, verdict in zip(messages, verdicts) if verdict]
+        bulk_cutoff = discord.utils.utcnow() - datetime.timedelta(days=14)
+        recent = [msg for msg in flagged if msg.created_at > bulk_cutoff]
+        if recent:
+            await channel.delete_messages(recent)
+        for msg in flagged:
+            if msg.created_at <= bulk_cutoff:
+                await msg.delete()
+        return len(flagged), verdicts.count(None)
 
     def _get_help_embed(self):
         embed = Embed(title="Osiris Help", description="Osiris is a chatbot that can be used to generate text in a conversation. It is trained on a large corpus of text from the internet, and can be used to generate text in a variety of styles.")
@@ -310,10 +382,12 @@ class ChatCommands(commands.Cog, name="chat_commands"):
                   ("osiris channel remove", "Remove a channel where the bot speaks."), ("osiris channel list", "List the channels where the bot speaks."),
                   ("osiris new", "Start a new conversation."), ("osiris opt get", "Get the conversation data collection status for your server."),
                   ("osiris opt in", "Opt your server in to conversation data collection."), ("osiris opt out", "Opt your server out of conversation data collection."),
+                  ("osiris stream get", "Get whether replies are streamed as they are written."), ("osiris stream on/off", "Stream replies as they are written, or send them once complete."),
                   ("osiris model set", "Set the model for the server."), ("osiris model get", "Get the model for the server."),
                   ("osiris export", "Export conversation data for the server."), ("osiris temp get", "Get the chatcompletion temperature for the server."),
                   ("osiris temp set", "Set the chatcompletion temperature for the server."), ("osiris instructions get", "Get Osiris' instructions in the server."),
-                  ("osiris instructions set", "Set Osiris' instructions in the server.")]
+                  ("osiris instructions set", "Set Osiris' instructions in the server."),
+                  ("osiris clean", "Delete flagged messages among the channel's last messages (100 by default).")]
         for name, value in fields:
             embed.add_field(name=name, value=value, inline=False)
         return embed
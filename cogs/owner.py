@@ -11,7 +11,7 @@ from discord import app_commands
 from discord.ext import commands
 from discord.ext.commands import Context
 
-from helpers import checks, db_manager
+from helpers import checks, completion_cache, db_manager, oai_helper
 
 
 class Owner(commands.Cog, name="owner"):
@@ -171,6 +171,66 @@ class Owner(commands.Cog, name="owner"):
         )
         await context.send(embed=embed)
 
+    @commands.hybrid_command(
+        name="upstream",
+        description="Shows the health of the OpenAI API.",
+    )
+    @checks.is_owner()
+    async def upstream(self, context: Context) -> None:
+        """
+        Shows the state of the circuit breaker guarding OpenAI API completions.
+
+        :param context: The hybrid command context.
+        """
+        breaker = oai_helper.completions.breaker.stats()
+        embed = discord.Embed(
+            title="OpenAI API",
+            description=f"Circuit breaker is **{breaker['state']}**",
+            color=0x9C84EF if breaker["state"] == "closed" else 0xE02B2B,
+        )
+        embed.add_field(name="Consecutive failures", value=breaker["failures"])
+        embed.add_field(name="Times opened", value=breaker["times_opened"])
+        if breaker["retry_in"] > 0:
+            embed.add_field(name="Retrying in", value=f"{round(breaker['retry_in'])} seconds")
+        if breaker["last_error"]:
+            embed.add_field(name="Last error", value=breaker["last_error"], inline=False)
+        chat = self.bot.get_cog("chat")
+        if chat is not None and chat.jobs is not None:
+            embed.add_field(name="Reply queue", value=f"{chat.jobs.pending} waiting, {chat.jobs.running} generating")
+        cache = completion_cache.stats()
+        if cache["enabled"]:
+            embed.add_field(
+                name="Completion cache",
+                value=f"{cache['hits']} hits, {cache['misses']} misses ({cache['hit_rate']:.0%}), {cache['size']} cached",
+                inline=False,
+            )
+        await context.send(embed=embed)
+
+    @commands.hybrid_command(
+        name="reload-config",
+        description="Reloads the config file.",
+    )
+    @checks.is_owner()
+    async def reload_config(self, context: Context) -> None:
+        """
+        Reloads the config file without restarting the bot.
+
+        :param context: The hybrid command context.
+        """
+        try:
+            self.bot.config.reload()
+        except Exception as e:
+            embed = discord.Embed(
+                description=f"Could not reload the config: {e}", color=0xE02B2B
+            )
+            await context.send(embed=embed)
+            return
+        self.bot.dispatch("config_reload")
+        embed = discord.Embed(
+            description="Successfully reloaded the config.", color=0x9C84EF
+        )
+        await context.send(embed=embed)
+
     @commands.hybrid_command(
         name="shutdown",
         description="Make the bot shutdown.",
@@ -186,6 +246,28 @@ class Owner(commands.Cog, name="owner"):
         await context.send(embed=embed)
         await self.bot.close()
 
+    @commands.hybrid_command(
+        name="keys",
+        description="Shows the usage of each OpenAI API key.",
+    )
+    @checks.is_owner()
+    async def keys(self, context: Context) -> None:
+        """
+        Shows the usage and rate limit headroom of each OpenAI API key.
+
+        :param context: The hybrid command context.
+        """
+        embed = discord.Embed(title="OpenAI API Keys", color=0x9C84EF)
+        for key in oai_helper.keys.stats():
+            remaining = f"{key['remaining_requests']} requests, {key['remaining_tokens']} tokens" if key["remaining_requests"] is not None else "unknown"
+            benched = f"\nBenched for {round(key['benched_for'])} seconds" if key["benched_for"] > 0 else ""
+            embed.add_field(
+                name=key["key"],
+                value=f"{key['requests']} requests, {key['errors']} errors, {key['rate_limited']} rate limited\nRemaining: {remaining}{benched}",
+                inline=False,
+            )
+        await context.send(embed=embed)
+
     @commands.hybrid_command(
         name="say",
         description="The bot will say anything you want.",
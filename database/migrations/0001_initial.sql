@@ -22,4 +22,4 @@ CREATE TABLE IF NOT EXISTS `messages` (
   `content` text NOT NULL,
   `created_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
   FOREIGN KEY (`guild_id`) REFERENCES `guilds` (`guild_id`)
-);
\ No newline at end of file
+);
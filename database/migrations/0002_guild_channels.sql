@@ -0,0 +1,14 @@
+CREATE TABLE IF NOT EXISTS `guild_channels` (
+  `guild_id` varchar(20) NOT NULL,
+  `channel_id` varchar(20) NOT NULL,
+  PRIMARY KEY (`guild_id`, `channel_id`)
+);
+
+-- Move channels still stored in the legacy comma-separated `guilds.channels` column into `guild_channels`.
+WITH RECURSIVE `split`(`guild_id`, `channel_id`, `rest`) AS (
+  SELECT `guild_id`, '', `channels` || ',' FROM `guilds` WHERE `channels` IS NOT NULL AND `channels` != ''
+  UNION ALL
+  SELECT `guild_id`, substr(`rest`, 1, instr(`rest`, ',') - 1), substr(`rest`, instr(`rest`, ',') + 1) FROM `split` WHERE `rest` != ''
+)
+INSERT OR IGNORE INTO `guild_channels`(`guild_id`, `channel_id`) SELECT `guild_id`, `channel_id` FROM `split` WHERE `channel_id` != '';
+UPDATE `guilds` SET `channels` = '' WHERE `channels` != '';
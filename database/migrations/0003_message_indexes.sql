@@ -0,0 +1,2 @@
+CREATE INDEX IF NOT EXISTS `messages_guild_id_created_at` ON `messages` (`guild_id`, `created_at`);
+CREATE INDEX IF NOT EXISTS `messages_channel_id_created_at` ON `messages` (`channel_id`, `created_at`);
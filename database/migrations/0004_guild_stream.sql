@@ -0,0 +1 @@
+ALTER TABLE `guilds` ADD COLUMN `stream` int(1) DEFAULT 0;
@@ -0,0 +1,6 @@
+CREATE TABLE IF NOT EXISTS `moderation_verdicts` (
+  `content_hash` char(64) NOT NULL,
+  `flagged` int(1) NOT NULL,
+  `created_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`content_hash`)
+);
@@ -0,0 +1,8 @@
+CREATE TABLE IF NOT EXISTS `completion_cache` (
+  `cache_key` char(64) NOT NULL,
+  `content` text NOT NULL,
+  `expires_at` real NOT NULL,
+  PRIMARY KEY (`cache_key`)
+);
+
+CREATE INDEX IF NOT EXISTS `completion_cache_expires_at` ON `completion_cache` (`expires_at`);
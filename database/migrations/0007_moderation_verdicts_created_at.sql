@@ -0,0 +1 @@
+CREATE INDEX IF NOT EXISTS `moderation_verdicts_created_at` ON `moderation_verdicts` (`created_at`);
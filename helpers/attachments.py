@@ -0,0 +1,55 @@
+import discord
+from helpers import http_client
+from helpers.lru import LRUCache
+
+SUPPORTED_FILETYPES = ["txt", "log", "py", "js", "json", "html", "css", "md", "csv", "tsv", "xml", "yaml", "yml", "ini", "cfg", "toml", "sh", "bat", "ps1", "psm1", "psd1", "ps1xml", "psc1", "pssc", "reg", "inf", "sql"]
+
+MAX_ATTACHMENT_CHARS = 100000
+
+# a UTF-8 character is at most 4 bytes, so this many bytes always hold MAX_ATTACHMENT_CHARS characters
+MAX_ATTACHMENT_BYTES = MAX_ATTACHMENT_CHARS * 4
+
+_contents = LRUCache(4096, max_bytes=32 * 1024 * 1024, sizeof=lambda text: len(text.encode("utf-8")))
+
+def configure(max_bytes: int = 32 * 1024 * 1024) -> None:
+    """
+    Sets how much decoded attachment text is kept in memory.
+    """
+    global _contents
+    _contents = LRUCache(4096, max_bytes=max_bytes, sizeof=lambda text: len(text.encode("utf-8")))
+
+def is_supported(attachment: discord.Attachment) -> bool:
+    return attachment.filename.split(".")[-1] in SUPPORTED_FILETYPES
+
+async def _download(attachment: discord.Attachment, limit: int) -> bytes:
+    """
+    Downloads at most `limit` bytes of the attachment, asking the CDN for just that range.
+    """
+    headers = {"Range": f"bytes=0-{limit - 1}"}
+    async with http_client.get_session().get(attachment.url, headers=headers) as response:
+        response.raise_for_status()
+        data = bytearray()
+        while len(data) < limit:
+            chunk = await response.content.read(limit - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return bytes(data)
+
+async def read_text(attachment: discord.Attachment) -> str:
+    """
+    Returns the text of the attachment, truncated to MAX_ATTACHMENT_CHARS characters.
+
+    Texts are cached by attachment ID, so an attachment that stays in the conversation is only downloaded once, and
+    attachments larger than MAX_ATTACHMENT_BYTES are only partially downloaded.
+    """
+    text = _contents.get(attachment.id)
+    if text is not None:
+        return text
+    if attachment.size <= MAX_ATTACHMENT_BYTES:
+        data = await attachment.read()
+    else:
+        data = await _download(attachment, MAX_ATTACHMENT_BYTES)
+    text = data.decode("utf-8", errors="ignore")[:MAX_ATTACHMENT_CHARS]
+    _contents.set(attachment.id, text)
+    return text
@@ -2,16 +2,13 @@ from typing import Callable, TypeVar
 from discord.ext import commands
 from exceptions import UserNotOwner, UserNotServerAdmin, UserBlacklisted
 from helpers import db_manager
-import json
-import os
 
 T = TypeVar("T")
 
 def is_owner() -> Callable[[T], T]:
     async def predicate(context: commands.Context) -> bool:
-        with open(f"{os.path.dirname(__file__)}/../config.json") as file:
-            if context.author.id not in json.load(file)["owners"]:
-                raise UserNotOwner
+        if context.author.id not in context.bot.config["owners"]:
+            raise UserNotOwner
         return True
     return commands.check(predicate)
 
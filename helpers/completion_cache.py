@@ -0,0 +1,78 @@
+import hashlib
+import json
+import time
+
+from helpers import db_manager
+from helpers.lru import LRUCache
+
+_entries = LRUCache(1)
+
+_enabled = False
+
+_ttl = 3600.0
+
+_persist = False
+
+hits = 0
+
+misses = 0
+
+def configure(size: int = 0, ttl: float = 3600.0, persist: bool = False) -> None:
+    """
+    Sets how many completions are cached in memory, for how many seconds, and whether they are also stored in the
+    database. A size of 0 disables the cache.
+    """
+    global _entries, _enabled, _ttl, _persist
+    _enabled = size > 0
+    _entries = LRUCache(max(1, size))
+    _ttl = ttl
+    _persist = persist
+
+def is_enabled() -> bool:
+    return _enabled
+
+def is_cacheable(temp: float) -> bool:
+    """
+    Returns whether completions at this temperature are worth caching. Only temperature 0 gives (nearly)
+    deterministic replies, anything higher is expected to vary between calls.
+    """
+    return is_enabled() and temp == 0
+
+def key(model: str, temp: float, messages: list) -> str:
+    return hashlib.sha256(json.dumps([model, temp, messages], sort_keys=True).encode("utf-8")).hexdigest()
+
+async def get(cache_key: str) -> str:
+    """
+    Returns the cached completion for the key, or None if there is none or it has expired.
+    """
+    global hits, misses
+    now = time.time()
+    entry = _entries.get(cache_key)
+    if entry is not None and entry[1] <= now:
+        _entries.pop(cache_key)
+        entry = None
+    if entry is None and _persist:
+        entry = await db_manager.get_cached_completion(cache_key, now)
+        if entry is not None:
+            _entries.set(cache_key, entry)
+    if entry is None:
+        misses += 1
+        return None
+    hits += 1
+    return entry[0]
+
+async def put(cache_key: str, content: str) -> None:
+    expires_at = time.time() + _ttl
+    _entries.set(cache_key, (content, expires_at))
+    if _persist:
+        await db_manager.add_cached_completion(cache_key, content, expires_at)
+
+def stats() -> dict:
+    lookups = hits + misses
+    return {
+        "enabled": is_enabled(),
+        "size": len(_entries),
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / lookups if lookups else 0.0,
+    }
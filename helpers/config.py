@@ -0,0 +1,70 @@
+import json
+import os
+from typing import Any
+
+# keys every config must have, with their expected type
+REQUIRED_KEYS = {
+    "prefix": str,
+    "token": str,
+    "openai_api_key": str,
+    "owners": list,
+}
+
+
+class Config:
+    """
+    The bot's configuration, read from `config.json` once and kept in memory.
+
+    The file is only read again by `reload`, or by `reload_if_changed` when its modification time has changed, so
+    looking up a setting never touches the disk. A config that fails validation is rejected and the previous one
+    stays in use.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._data = {}
+        self._mtime = None
+        self.reload()
+
+    @staticmethod
+    def validate(data: dict) -> None:
+        """
+        Raises a ValueError if the config is missing a required key or has one of the wrong type.
+        """
+        if not isinstance(data, dict):
+            raise ValueError("The config must be a JSON object.")
+        for key, expected in REQUIRED_KEYS.items():
+            if key not in data:
+                raise ValueError(f"The config is missing the '{key}' key.")
+            if not isinstance(data[key], expected):
+                raise ValueError(f"The config key '{key}' must be of type {expected.__name__}.")
+        if not any(key.strip() for key in data["openai_api_key"].split(",")):
+            raise ValueError("The config key 'openai_api_key' must contain at least one key.")
+
+    def reload(self) -> None:
+        """
+        Reads and validates the config file.
+        """
+        self._mtime = os.stat(self.path).st_mtime_ns
+        with open(self.path) as file:
+            data = json.load(file)
+        self.validate(data)
+        self._data = data
+
+    def reload_if_changed(self) -> bool:
+        """
+        Reloads the config if the file has been modified since it was last read, and returns whether it was.
+        """
+        if os.stat(self.path).st_mtime_ns == self._mtime:
+            return False
+        self.reload()
+        return True
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self._data.get(key, default)
+
+    def __getitem__(self, key: str) -> Any:
+        return self._data[key]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._data
@@ -0,0 +1,71 @@
+import asyncio
+import re
+
+from helpers import attachments, tokens
+from helpers.lru import LRUCache
+from helpers.oai_helper import MAX_TOKENS
+
+# attachment excerpts by (attachment id, model, token budget), as encoding a long attachment takes a while
+_excerpts = LRUCache(1024, max_bytes=16 * 1024 * 1024, sizeof=lambda excerpt: len(excerpt[0]))
+
+async def _fit_attachment(attachment, text: str, model: str, max_tokens: int) -> tuple:
+    """
+    Returns the longest start of the attachment's text that fits in `max_tokens` tokens, and its number of tokens.
+    Attachments can be long, so they are encoded in a thread instead of on the event loop.
+    """
+    key = (attachment.id, model, max_tokens)
+    excerpt = _excerpts.get(key)
+    if excerpt is None:
+        excerpt = await asyncio.to_thread(tokens.fit, text, max_tokens, model)
+        _excerpts.set(key, excerpt)
+    return excerpt
+
+async def build(instructions: str, history: list, model: str, bot_user) -> tuple:
+    """
+    Returns the chat completion messages for the conversation, packed to fit the model's context window, and the
+    texts to moderate for them.
+
+    The system instructions always come first and room is left for a reply of MAX_TOKENS tokens. Messages are then
+    added from the newest to the oldest until the budget runs out, each followed by as much of its text attachments
+    as still fits. Attachments are only downloaded when there is room left for them.
+
+    The texts to moderate are the whole messages and attachments rather than the packed contents, whose excerpts
+    change with the budget left, so each of them is only ever moderated once.
+    """
+    budget = tokens.context_window(model) - MAX_TOKENS - tokens.TOKENS_PER_REPLY - tokens.TOKENS_PER_MESSAGE - tokens.count(instructions, model)
+    packed = []
+    moderated = [instructions]
+
+    for msg in reversed(history):
+        role = "user" if msg.author != bot_user else "assistant"
+        name = re.sub(r"[^a-zA-Z0-9]", "", msg.author.display_name)
+        content = msg.content
+        cost = tokens.TOKENS_PER_MESSAGE + 1 + tokens.count(content, model)
+        if cost > budget:
+            if packed:
+                break
+            # always keep the message being replied to, even if only part of it fits
+            content = tokens.truncate(content, budget - tokens.TOKENS_PER_MESSAGE - 1, model)
+            cost = budget
+        budget -= cost
+        moderated.append(msg.content)
+
+        for attachment in msg.attachments:
+            if not attachments.is_supported(attachment):
+                continue
+            header, footer = "\n\n" + attachment.filename + ":\n```\n", "\n```"
+            overhead = tokens.count(header, model) + tokens.count(footer, model)
+            if budget <= overhead:
+                break
+            text = await attachments.read_text(attachment)
+            excerpt, cost = await _fit_attachment(attachment, text, model, budget - overhead)
+            if not excerpt:
+                break
+            moderated.append(text)
+            content += header + excerpt + footer
+            budget -= overhead + cost
+
+        packed.append({"role": role, "content": content, "name": name})
+
+    packed.reverse()
+    return [{"role": "system", "content": instructions}] + packed, moderated
@@ -1,103 +1,289 @@
 import os
-import aiosqlite
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from helpers import metrics
+from helpers.db_pool import ConnectionPool
+from helpers.write_behind import WriteBehindQueue
 
 DATABASE_PATH = f"{os.path.realpath(os.path.dirname(__file__))}/../database/database.db"
 
+_pool = ConnectionPool(DATABASE_PATH)
+
+_message_log = None
+
+_verdict_log = None
+
+_completion_log = None
+
+# stored moderation verdicts older than this many days are deleted
+_verdict_retention_days = 30
+
+def _timed(function):
+    """
+    Records how long every call of the helper takes.
+    """
+    return metrics.timed(metrics.DB_SECONDS, helper=function.__name__)(function)
+
+async def connect(readers: int = 4, log_batch_size: int = 500, log_flush_interval: float = 0.25, verdict_retention_days: float = 30) -> None:
+    """
+    Opens the shared connection pool used by every helper of this module and starts the batched writers.
+    """
+    global _pool, _message_log, _verdict_log, _completion_log, _verdict_retention_days
+    _verdict_retention_days = verdict_retention_days
+    if not _pool.is_open:
+        _pool = ConnectionPool(DATABASE_PATH, readers=readers)
+    if _message_log is None:
+        _message_log = WriteBehindQueue(_write_messages, batch_size=log_batch_size, flush_interval=log_flush_interval)
+    if _verdict_log is None:
+        _verdict_log = WriteBehindQueue(_write_moderation_verdicts, batch_size=log_batch_size, flush_interval=log_flush_interval)
+    if _completion_log is None:
+        _completion_log = WriteBehindQueue(_write_cached_completions, batch_size=log_batch_size, flush_interval=log_flush_interval)
+    await _pool.open()
+    _message_log.start()
+    _verdict_log.start()
+    _completion_log.start()
+
+async def close() -> None:
+    """
+    Writes the queued rows and closes the shared connection pool.
+    """
+    if _message_log is not None:
+        await _message_log.close()
+    if _verdict_log is not None:
+        await _verdict_log.close()
+    if _completion_log is not None:
+        await _completion_log.close()
+    await _pool.close()
+
+@dataclass
+class GuildSettings:
+    """
+    The per-guild settings stored in one row of the `guilds` table.
+    """
+    guild_id: int
+    model: str
+    temperature: float
+    opt: int
+    instructions: str
+    stream: int
+
+_GUILD_SETTINGS_QUERY = "SELECT guild_id, model, temperature, opt, instructions, stream FROM guilds"
+
+_guild_settings = {}
+
+# bumped by every write to a guild's settings, so that a read that raced with a write isn't cached
+_guild_versions = {}
+
+_blacklist = set()
+
+_channels = set()
+
+def _cache_guild_settings(row) -> GuildSettings:
+    settings = GuildSettings(int(row[0]), row[1], row[2], row[3], row[4], row[5])
+    _guild_settings[settings.guild_id] = settings
+    return settings
+
+def _update_guild_settings(guild_id: int, **fields) -> None:
+    _guild_versions[int(guild_id)] = _guild_versions.get(int(guild_id), 0) + 1
+    settings = _guild_settings.get(int(guild_id))
+    if settings is not None:
+        for name, value in fields.items():
+            setattr(settings, name, value)
+
+@_timed
+async def load_guild_settings() -> int:
+    """
+    Loads the settings of every guild into the in-memory cache and returns how many were loaded.
+    """
+    versions = dict(_guild_versions)
+    async with _pool.reader() as db:
+        async with db.execute(_GUILD_SETTINGS_QUERY) as cursor:
+            rows = await cursor.fetchall()
+    _guild_settings.clear()
+    for row in rows:
+        # guilds written to during the read are read again when next needed
+        if _guild_versions.get(int(row[0])) == versions.get(int(row[0])):
+            _cache_guild_settings(row)
+    return len(rows)
+
+@_timed
+async def get_guild_settings(guild_id: int) -> GuildSettings:
+    """
+    Returns the settings for the guild, reading the database only when they are not cached yet.
+    """
+    while True:
+        settings = _guild_settings.get(int(guild_id))
+        if settings is not None:
+            return settings
+        version = _guild_versions.get(int(guild_id))
+        async with _pool.reader() as db:
+            async with db.execute(_GUILD_SETTINGS_QUERY + " WHERE guild_id=?", (guild_id,)) as cursor:
+                result = await cursor.fetchone()
+        if result is None:
+            return None
+        # a write that committed during the read may not be in the row, so it is read again
+        if _guild_versions.get(int(guild_id)) == version:
+            return _cache_guild_settings(result)
+
+@_timed
 async def get_blacklisted_users() -> list:
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _pool.reader() as db:
         async with db.execute(
             "SELECT user_id, strftime('%s', created_at) FROM blacklist"
         ) as cursor:
             result = await cursor.fetchall()
             return result
 
+@_timed
+async def load_blacklist() -> int:
+    """
+    Loads the blacklisted user IDs into memory and returns how many were loaded.
+    """
+    _blacklist.clear()
+    _blacklist.update(int(user[0]) for user in await get_blacklisted_users())
+    return len(_blacklist)
+
+@_timed
 async def is_blacklisted(user_id: int) -> bool:
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        async with db.execute(
-            "SELECT * FROM blacklist WHERE user_id=?", (user_id,)
-        ) as cursor:
-            result = await cursor.fetchone()
-            return result is not None
+    """
+    Returns whether the user is blacklisted, using the in-memory copy of the blacklist.
+    """
+    return int(user_id) in _blacklist
 
+@_timed
 async def add_user_to_blacklist(user_id: int) -> int:
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _pool.writer() as db:
         await db.execute("INSERT INTO blacklist(user_id) VALUES (?)", (user_id,))
         await db.commit()
+        _blacklist.add(int(user_id))
         rows = await db.execute("SELECT COUNT(*) FROM blacklist")
         async with rows as cursor:
             result = await cursor.fetchone()
             return result[0] if result is not None else 0
 
+@_timed
 async def remove_user_from_blacklist(user_id: int) -> int:
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _pool.writer() as db:
         await db.execute("DELETE FROM blacklist WHERE user_id=?", (user_id,))
         await db.commit()
+        _blacklist.discard(int(user_id))
         rows = await db.execute("SELECT COUNT(*) FROM blacklist")
         async with rows as cursor:
             result = await cursor.fetchone()
             return result[0] if result is not None else 0
 
+@_timed
+async def load_channels() -> int:
+    """
+    Loads the IDs of every channel Osiris speaks in into memory and returns how many were loaded.
+    """
+    async with _pool.reader() as db:
+        async with db.execute("SELECT channel_id FROM guild_channels") as cursor:
+            rows = await cursor.fetchall()
+    _channels.clear()
+    _channels.update(int(row[0]) for row in rows)
+    return len(_channels)
+
+@_timed
+async def is_channel_enabled(channel_id: int) -> bool:
+    """
+    Returns whether Osiris speaks in the channel, using the in-memory routing table.
+    """
+    return int(channel_id) in _channels
+
+@_timed
 async def add_channel(guild_id: int, channel_id: int) -> None:
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        async with db.execute("SELECT channels FROM guilds WHERE guild_id=?", (str(guild_id),)) as cursor:
-            result = await cursor.fetchone()
-            if result is None:
-                channels = str(channel_id)
-                await db.execute(
-                    "INSERT INTO guilds(guild_id, channels) VALUES (?, ?)",
-                    (str(guild_id), channels),
-                )
-            else:
-                channels = result[0] + ',' + str(channel_id) if result[0] else str(channel_id)
-                await db.execute(
-                    "UPDATE guilds SET channels=? WHERE guild_id=?",
-                    (channels, str(guild_id)),
-                )
+    async with _pool.writer() as db:
+        await db.execute("INSERT OR IGNORE INTO guilds(guild_id) VALUES (?)", (str(guild_id),))
+        await db.execute(
+            "INSERT OR IGNORE INTO guild_channels(guild_id, channel_id) VALUES (?, ?)",
+            (str(guild_id), str(channel_id)),
+        )
         await db.commit()
+    _channels.add(int(channel_id))
 
+@_timed
 async def remove_channel(guild_id: int, channel_id: int) -> None:
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        async with db.execute("SELECT channels FROM guilds WHERE guild_id=?", (str(guild_id),)) as cursor:
-            result = await cursor.fetchone()
-            if result is None:
-                return
-            channels = result[0].split(',')
-            channels.remove(str(channel_id))
-            channels_str = ','.join(channels)
-            await db.execute(
-                "UPDATE guilds SET channels=? WHERE guild_id=?",
-                (channels_str, str(guild_id)),
-            )
+    async with _pool.writer() as db:
+        await db.execute(
+            "DELETE FROM guild_channels WHERE guild_id=? AND channel_id=?",
+            (str(guild_id), str(channel_id)),
+        )
         await db.commit()
+    _channels.discard(int(channel_id))
 
+@_timed
 async def get_channels(guild_id: int) -> list:
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        async with db.execute("SELECT channels FROM guilds WHERE guild_id=?", (str(guild_id),)) as cursor:
-            result = await cursor.fetchone()
-            return result[0].split(',') if result and result[0] else None
+    async with _pool.reader() as db:
+        async with db.execute("SELECT channel_id FROM guild_channels WHERE guild_id=?", (str(guild_id),)) as cursor:
+            result = await cursor.fetchall()
+            return [row[0] for row in result] if result else None
 
+@_timed
 async def is_guild_in_db(guild_id: int) -> bool:
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _pool.reader() as db:
         async with db.execute("SELECT * FROM guilds WHERE guild_id=?", (str(guild_id),)) as cursor:
             result = await cursor.fetchone()
             return result is not None
         
+@_timed
 async def add_guild(guild_id: int) -> None:
     """
-    Adds a guild to the database.
+    Adds a guild to the database, if it isn't there yet.
+    """
+    async with _pool.writer() as db:
+        await db.execute(
+            "INSERT OR IGNORE INTO guilds(guild_id) VALUES (?)",
+            (str(guild_id),),
+        )
+        await db.commit()
+
+@_timed
+async def add_guilds(guild_ids: list) -> int:
+    """
+    Adds the guilds that aren't in the database yet and returns how many were added.
+
+    The known guilds are read in one query and the missing ones inserted in a single transaction, so reconciling
+    thousands of guilds costs two round trips instead of two per guild.
+    """
+    async with _pool.reader() as db:
+        async with db.execute("SELECT guild_id FROM guilds") as cursor:
+            known = {row[0] for row in await cursor.fetchall()}
+    missing = [(str(guild_id),) for guild_id in dict.fromkeys(guild_ids) if str(guild_id) not in known]
+    if missing:
+        async with _pool.writer() as db:
+            await db.executemany("INSERT OR IGNORE INTO guilds(guild_id) VALUES (?)", missing)
+            await db.commit()
+    return len(missing)
+
+@_timed
+async def delete_guild(guild_id: int) -> None:
+    """
+    Removes a guild from the database.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _pool.writer() as db:
+        async with db.execute("SELECT channel_id FROM guild_channels WHERE guild_id=?", (str(guild_id),)) as cursor:
+            channels = [int(row[0]) for row in await cursor.fetchall()]
+        await db.execute(
+            "DELETE FROM guild_channels WHERE guild_id=?",
+            (str(guild_id),),
+        )
         await db.execute(
-            "INSERT INTO guilds(guild_id) VALUES (?)",
+            "DELETE FROM guilds WHERE guild_id=?",
             (guild_id,),
         )
         await db.commit()
+    _channels.difference_update(channels)
+    _update_guild_settings(guild_id)
+    _guild_settings.pop(int(guild_id), None)
 
+@_timed
 async def set_model(guild_id: int, model: str) -> None:
     """
     Sets the model for the guild.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _pool.writer() as db:
         await db.execute(
             "INSERT OR IGNORE INTO guilds(guild_id, model) VALUES (?, ?)",
             (guild_id, model),
@@ -107,23 +293,22 @@ async def set_model(guild_id: int, model: str) -> None:
             (model, guild_id),
         )
         await db.commit()
+    _update_guild_settings(guild_id, model=model)
 
+@_timed
 async def get_model(guild_id: int) -> str:
     """
     Returns the model for the guild.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        async with db.execute(
-            "SELECT model FROM guilds WHERE guild_id=?", (guild_id,)
-        ) as cursor:
-            result = await cursor.fetchone()
-            return result[0] if result is not None else None
+    settings = await get_guild_settings(guild_id)
+    return settings.model if settings is not None else None
         
+@_timed
 async def set_temperature(guild_id: int, temperature: float) -> None:
     """
     Sets the temperature for the guild.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _pool.writer() as db:
         await db.execute(
             "INSERT OR IGNORE INTO guilds(guild_id, temperature) VALUES (?, ?)",
             (guild_id, temperature),
@@ -133,34 +318,30 @@ async def set_temperature(guild_id: int, temperature: float) -> None:
             (temperature, guild_id),
         )
         await db.commit()
+    _update_guild_settings(guild_id, temperature=temperature)
 
+@_timed
 async def get_temperature(guild_id: int) -> float:
     """
     Returns the temperature for the guild.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        async with db.execute(
-            "SELECT temperature FROM guilds WHERE guild_id=?", (guild_id,)
-        ) as cursor:
-            result = await cursor.fetchone()
-            return result[0] if result is not None else None
+    settings = await get_guild_settings(guild_id)
+    return settings.temperature if settings is not None else None
         
+@_timed
 async def get_instructions(guild_id: int) -> str:
     """
     Returns the system message for the guild.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        async with db.execute(
-            "SELECT instructions FROM guilds WHERE guild_id=?", (guild_id,)
-        ) as cursor:
-            result = await cursor.fetchone()
-            return result[0] if result is not None else None
+    settings = await get_guild_settings(guild_id)
+    return settings.instructions if settings is not None else None
         
+@_timed
 async def set_instructions(guild_id: int, instructions: str) -> None:
     """
     Sets the system message for the guild.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _pool.writer() as db:
         await db.execute(
             "INSERT OR IGNORE INTO guilds(guild_id, instructions) VALUES (?, ?)",
             (guild_id, instructions),
@@ -170,12 +351,14 @@ async def set_instructions(guild_id: int, instructions: str) -> None:
             (instructions, guild_id),
         )
         await db.commit()
+    _update_guild_settings(guild_id, instructions=instructions)
 
+@_timed
 async def opt_in(guild_id: int) -> None:
     """
     Opts the selected guild into conversation logging.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _pool.writer() as db:
         await db.execute(
             "INSERT OR IGNORE INTO guilds(guild_id, opt) VALUES (?, ?)",
             (guild_id, 1),
@@ -185,12 +368,16 @@ async def opt_in(guild_id: int) -> None:
             (1, guild_id),
         )
         await db.commit()
+    _update_guild_settings(guild_id, opt=1)
 
+@_timed
 async def opt_out(guild_id: int) -> None:
     """
     Opts the selected guild out of conversation logging. Deletes all messages from the database as a part of this.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    _update_guild_settings(guild_id, opt=0)
+    await flush_messages()
+    async with _pool.writer() as db:
         await db.execute(
             "INSERT OR IGNORE INTO guilds(guild_id, opt) VALUES (?, ?)",
             (guild_id, 0),
@@ -204,29 +391,68 @@ async def opt_out(guild_id: int) -> None:
             (guild_id,),
         )
         await db.commit()
+    # again, in case the settings were read before the commit
+    _update_guild_settings(guild_id, opt=0)
 
+@_timed
 async def get_opt(guild_id: int) -> int:
     """
     Returns the opt-out status for the guild.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        async with db.execute(
-            "SELECT opt FROM guilds WHERE guild_id=?", (guild_id,)
-        ) as cursor:
-            result = await cursor.fetchone()
-            return result[0] if result is not None else None
+    settings = await get_guild_settings(guild_id)
+    return settings.opt if settings is not None else None
 
-async def add_message(guild_id: int, author_id: int, channel_id: int, content: str) -> None:
+@_timed
+async def set_stream(guild_id: int, stream: bool) -> None:
     """
-    Adds a message to the database.
+    Sets whether replies are streamed into the channel as they are generated for the guild.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _pool.writer() as db:
+        await db.execute(
+            "INSERT OR IGNORE INTO guilds(guild_id, stream) VALUES (?, ?)",
+            (guild_id, int(stream)),
+        )
         await db.execute(
-            "INSERT INTO messages(guild_id, author_id, channel_id, content) VALUES (?, ?, ?, ?)",
-            (guild_id, author_id, channel_id, content),
+            "UPDATE guilds SET stream=? WHERE guild_id=?",
+            (int(stream), guild_id),
         )
         await db.commit()
+    _update_guild_settings(guild_id, stream=int(stream))
+
+@_timed
+async def get_stream(guild_id: int) -> int:
+    """
+    Returns whether replies are streamed for the guild.
+    """
+    settings = await get_guild_settings(guild_id)
+    return settings.stream if settings is not None else None
 
+@_timed
+async def _write_messages(rows: list) -> None:
+    async with _pool.writer() as db:
+        await db.executemany(
+            "INSERT INTO messages(guild_id, author_id, channel_id, content, created_at) VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+        await db.commit()
+
+@_timed
+async def add_message(guild_id: int, author_id: int, channel_id: int, content: str) -> None:
+    """
+    Queues a message to be added to the database with the next batch of logged messages.
+    """
+    created_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    await _message_log.put((guild_id, author_id, channel_id, content, created_at))
+
+@_timed
+async def flush_messages() -> None:
+    """
+    Waits until every queued message has been written to the database.
+    """
+    if _message_log is not None:
+        await _message_log.flush()
+
+@_timed
 async def get_messages(guild_id: int) -> list:
     """
     Returns all messages for the guild.
@@ -240,10 +466,98 @@ async def get_messages(guild_id: int) -> list:
         FOREIGN KEY (`guild_id`) REFERENCES `guilds` (`guild_id`)
     );
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    await flush_messages()
+    async with _pool.reader() as db:
         async with db.execute(
             "SELECT author_id, content FROM messages WHERE guild_id=?",
             (guild_id,),
         ) as cursor:
             result = [dict(row) for row in await cursor.fetchall()]
-            return result
\ No newline at end of file
+            return result
+
+async def iter_messages(guild_id: int, batch_size: int = 1000):
+    """
+    Yields all messages for the guild in batches, oldest first.
+
+    Each batch is a separate keyset-paginated query, so memory use is bounded by one batch and no reader connection
+    is held between batches.
+    """
+    await flush_messages()
+    last = ("", 0)
+    while True:
+        async with _pool.reader() as db:
+            async with db.execute(
+                "SELECT rowid, author_id, content, created_at FROM messages WHERE guild_id=? AND (created_at, rowid) > (?, ?) ORDER BY created_at, rowid LIMIT ?",
+                (guild_id, *last, batch_size),
+            ) as cursor:
+                rows = await cursor.fetchall()
+        if not rows:
+            return
+        last = (rows[-1]["created_at"], rows[-1]["rowid"])
+        yield [dict(row) for row in rows]
+
+@_timed
+async def get_moderation_verdicts(content_hashes: list) -> dict:
+    """
+    Returns the stored moderation verdicts for the given content hashes, as a dict of hash to flagged.
+    """
+    if not content_hashes:
+        return {}
+    async with _pool.reader() as db:
+        async with db.execute(
+            f"SELECT content_hash, flagged FROM moderation_verdicts WHERE content_hash IN ({','.join('?' * len(content_hashes))})",
+            tuple(content_hashes),
+        ) as cursor:
+            return {row[0]: bool(row[1]) for row in await cursor.fetchall()}
+
+@_timed
+async def _write_moderation_verdicts(rows: list) -> None:
+    async with _pool.writer() as db:
+        await db.executemany(
+            "INSERT OR REPLACE INTO moderation_verdicts(content_hash, flagged) VALUES (?, ?)",
+            rows,
+        )
+        # drop the old ones while we hold the writer anyway, so the table doesn't grow forever
+        await db.execute(
+            "DELETE FROM moderation_verdicts WHERE created_at < datetime('now', ?)",
+            (f"-{_verdict_retention_days} days",),
+        )
+        await db.commit()
+
+@_timed
+async def add_moderation_verdict(content_hash: str, flagged: bool) -> None:
+    """
+    Queues a moderation verdict to be stored with the next batch.
+    """
+    await _verdict_log.put((content_hash, int(flagged)))
+
+@_timed
+async def get_cached_completion(cache_key: str, now: float) -> tuple:
+    """
+    Returns the stored completion and its expiry time for the cache key, or None if there is none or it has expired.
+    """
+    async with _pool.reader() as db:
+        async with db.execute(
+            "SELECT content, expires_at FROM completion_cache WHERE cache_key=? AND expires_at > ?",
+            (cache_key, now),
+        ) as cursor:
+            row = await cursor.fetchone()
+    return (row[0], row[1]) if row is not None else None
+
+@_timed
+async def _write_cached_completions(rows: list) -> None:
+    async with _pool.writer() as db:
+        await db.executemany(
+            "INSERT OR REPLACE INTO completion_cache(cache_key, content, expires_at) VALUES (?, ?, ?)",
+            rows,
+        )
+        # drop the expired ones while we hold the writer anyway
+        await db.execute("DELETE FROM completion_cache WHERE expires_at <= ?", (time.time(),))
+        await db.commit()
+
+@_timed
+async def add_cached_completion(cache_key: str, content: str, expires_at: float) -> None:
+    """
+    Queues a completion to be stored with the next batch.
+    """
+    await _completion_log.put((cache_key, content, expires_at))
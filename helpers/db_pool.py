@@ -0,0 +1,102 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+import aiosqlite
+
+
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -64000,
+    "mmap_size": 268435456,
+    "temp_store": "MEMORY",
+}
+
+
+class ConnectionPool:
+    """
+    A long-lived pool of SQLite connections: a single writer and a fixed number of readers.
+
+    SQLite only allows one writer at a time, so every write goes through the same connection behind a lock,
+    while reads are spread over the reader connections. Each connection keeps its own prepared statement cache,
+    so the helpers in db_manager reuse compiled statements instead of preparing them on every call.
+
+    Every connection is opened with `pragmas` (PRAGMAS by default): write-ahead logging so that readers never block
+    the writer, `synchronous=NORMAL` which is durable enough under WAL, and a larger page cache and memory map.
+    """
+
+    def __init__(self, path: str, readers: int = 4, cached_statements: int = 256, timeout: float = 30.0, pragmas: dict = None):
+        self.path = path
+        self.size = max(1, readers)
+        self.cached_statements = cached_statements
+        self.timeout = timeout
+        self.pragmas = PRAGMAS if pragmas is None else pragmas
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._readers = asyncio.Queue()
+        self._connections = []
+
+    async def _connect(self) -> aiosqlite.Connection:
+        db = await aiosqlite.connect(self.path, timeout=self.timeout, cached_statements=self.cached_statements)
+        db.row_factory = aiosqlite.Row
+        for name, value in self.pragmas.items():
+            await db.execute(f"PRAGMA {name}={value}")
+        self._connections.append(db)
+        return db
+
+    async def open(self) -> None:
+        """
+        Opens the writer and reader connections.
+        """
+        if self._writer is not None:
+            return
+        self._writer = await self._connect()
+        for _ in range(self.size):
+            self._readers.put_nowait(await self._connect())
+
+    async def close(self) -> None:
+        """
+        Waits for the in-flight write to finish and closes every connection of the pool.
+        """
+        async with self._write_lock:
+            if self._writer is not None:
+                await self._writer.execute("PRAGMA optimize")
+            for db in self._connections:
+                await db.close()
+            self._connections.clear()
+            self._writer = None
+            self._readers = asyncio.Queue()
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    @asynccontextmanager
+    async def reader(self) -> AsyncIterator[aiosqlite.Connection]:
+        """
+        Borrows a reader connection for the duration of the block.
+        """
+        if not self.is_open:
+            raise RuntimeError("The connection pool is not open.")
+        db = await self._readers.get()
+        try:
+            yield db
+        finally:
+            if db in self._connections:
+                self._readers.put_nowait(db)
+
+    @asynccontextmanager
+    async def writer(self) -> AsyncIterator[aiosqlite.Connection]:
+        """
+        Holds the writer connection exclusively for the duration of the block.
+        Anything left uncommitted when the block raises is rolled back.
+        """
+        if not self.is_open:
+            raise RuntimeError("The connection pool is not open.")
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
@@ -0,0 +1,44 @@
+import aiohttp
+
+_session = None
+
+_stream_timeout = None
+
+async def start(limit: int = 100, limit_per_host: int = 20, timeout: float = 120.0, keepalive_timeout: float = 30.0, stream_read_timeout: float = 60.0) -> None:
+    """
+    Creates the HTTP session shared by every outbound API call.
+
+    The session keeps connections alive between requests, so each call reuses an open TCP/TLS connection instead of
+    paying for a new handshake. `limit_per_host` caps how many connections are opened to a single API host.
+    Requests must finish within `timeout` seconds, except streamed ones, which may take as long as they need as long
+    as they never go `stream_read_timeout` seconds without receiving anything.
+    """
+    global _session, _stream_timeout
+    if _session is not None and not _session.closed:
+        return
+    connector = aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host, keepalive_timeout=keepalive_timeout)
+    _session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout))
+    _stream_timeout = aiohttp.ClientTimeout(total=None, connect=timeout, sock_read=stream_read_timeout)
+
+async def close() -> None:
+    """
+    Closes the shared HTTP session and its connections.
+    """
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    Returns the shared HTTP session.
+    """
+    if _session is None or _session.closed:
+        raise RuntimeError("The HTTP session has not been started.")
+    return _session
+
+def get_stream_timeout() -> aiohttp.ClientTimeout:
+    """
+    Returns the timeout of streamed requests, which unlike the session's doesn't bound the whole request.
+    """
+    return _stream_timeout
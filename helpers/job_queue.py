@@ -0,0 +1,181 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable
+
+from helpers import metrics
+
+
+class QueueFull(Exception):
+    """
+    Raised when a job is submitted to a queue that already holds as many jobs as it may.
+    """
+
+    def __init__(self):
+        super().__init__("The queue is full.")
+
+
+class Job:
+    """
+    A unit of work waiting in, or being run by, a JobQueue.
+    """
+
+    WAITING, RUNNING, DONE = "waiting", "running", "done"
+
+    def __init__(self, run: Callable[[], Awaitable[Any]], deadline: float, on_timeout: Callable[[], Awaitable[Any]] = None, cancellable: Callable[[], bool] = None):
+        self.run = run
+        self.deadline = deadline
+        self.on_timeout = on_timeout
+        self.cancellable = cancellable
+        self.enqueued_at = time.monotonic()
+        self.state = self.WAITING
+        self.task = None
+        # set by the queue, to take the job out of its line when it is dropped
+        self._on_drop = None
+
+    @property
+    def remaining(self) -> float:
+        return self.deadline - (time.monotonic() - self.enqueued_at)
+
+    def cancel(self) -> None:
+        """
+        Drops the job if it is still waiting, or cancels it if it is running.
+        """
+        if self.state == self.WAITING:
+            self.state = self.DONE
+            if self._on_drop is not None:
+                self._on_drop(self)
+        elif self.state == self.RUNNING and self.task is not None:
+            self.task.cancel()
+
+
+class JobQueue:
+    """
+    A bounded first-in, first-out queue of jobs run by a fixed number of workers.
+
+    At most `workers` jobs run at once and at most `max_pending` wait, so a burst of work costs queued objects
+    instead of hundreds of concurrent coroutines, and `submit` raises QueueFull once the queue is full so callers can
+    push back. Every job must finish within `deadline` seconds of being submitted, queueing included, or it is
+    dropped or cancelled and its `on_timeout` is called. A running job whose `cancellable` returns False when its
+    deadline passes, such as one that has started sending its results, is left to finish instead.
+    """
+
+    def __init__(self, name: str, workers: int = 16, max_pending: int = 200):
+        self.name = name
+        self.workers = max(1, workers)
+        self.max_pending = max(0, max_pending)
+        self.running = 0
+        self._pending = deque()
+        # released once per submitted job, so it never counts fewer jobs than are waiting
+        self._available = asyncio.Semaphore(0)
+        self._workers = []
+
+    def start(self) -> None:
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def close(self) -> None:
+        """
+        Stops the workers, cancelling the running jobs and dropping the waiting ones.
+        """
+        for job in self._pending:
+            job.state = Job.DONE
+        self._pending.clear()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._update_gauges()
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def submit(self, run: Callable[[], Awaitable[Any]], deadline: float, on_timeout: Callable[[], Awaitable[Any]] = None, cancellable: Callable[[], bool] = None) -> Job:
+        """
+        Queues `run` to be called by the next free worker, and returns its job.
+        """
+        if len(self._pending) >= self.max_pending:
+            metrics.QUEUE_JOBS_TOTAL.inc(queue=self.name, result="rejected")
+            raise QueueFull()
+        job = Job(run, deadline, on_timeout, cancellable)
+        job._on_drop = self._drop
+        self._pending.append(job)
+        self._available.release()
+        self._update_gauges()
+        return job
+
+    def position(self, job: Job) -> int:
+        """
+        Returns how many waiting jobs will be picked up before this one, or -1 if it isn't waiting. Jobs that idle
+        workers are about to pick up don't count, so a job submitted to an idle queue is at position 0.
+        """
+        if job.state != Job.WAITING:
+            return -1
+        # usually asked right after submitting, when the job is last in line
+        if self._pending and self._pending[-1] is job:
+            ahead = len(self._pending) - 1
+        else:
+            ahead = self._pending.index(job)
+        return max(0, ahead - (self.workers - self.running))
+
+    def _drop(self, job: Job) -> None:
+        # only waiting jobs are ever in the line, so its length is the number waiting
+        self._pending.remove(job)
+        self._update_gauges()
+
+    def _update_gauges(self) -> None:
+        metrics.QUEUE_DEPTH.set(len(self._pending), queue=self.name)
+        metrics.QUEUE_RUNNING.set(self.running, queue=self.name)
+
+    async def _next(self) -> Job:
+        while True:
+            await self._available.acquire()
+            if self._pending:
+                return self._pending.popleft()
+
+    async def _work(self) -> None:
+        while True:
+            job = await self._next()
+            metrics.QUEUE_WAIT_SECONDS.observe(time.monotonic() - job.enqueued_at, queue=self.name)
+            if job.remaining <= 0:
+                job.state = Job.DONE
+                self._update_gauges()
+                await self._time_out(job)
+                continue
+
+            job.state = Job.RUNNING
+            job.task = asyncio.create_task(job.run())
+            self.running += 1
+            self._update_gauges()
+            try:
+                await asyncio.wait({job.task}, timeout=job.remaining)
+                if not job.task.done() and job.cancellable is not None and not job.cancellable():
+                    # past its deadline, but cutting it off now would leave its results half done
+                    await asyncio.wait({job.task})
+                if not job.task.done():
+                    job.task.cancel()
+                    await asyncio.wait({job.task})
+                    await self._time_out(job)
+                elif job.task.cancelled():
+                    metrics.QUEUE_JOBS_TOTAL.inc(queue=self.name, result="cancelled")
+                elif job.task.exception() is not None:
+                    metrics.QUEUE_JOBS_TOTAL.inc(queue=self.name, result="failed")
+                else:
+                    metrics.QUEUE_JOBS_TOTAL.inc(queue=self.name, result="done")
+            except asyncio.CancelledError:
+                # the queue is closing
+                job.task.cancel()
+                raise
+            finally:
+                job.state = Job.DONE
+                self.running -= 1
+                self._update_gauges()
+
+    async def _time_out(self, job: Job) -> None:
+        metrics.QUEUE_JOBS_TOTAL.inc(queue=self.name, result="timeout")
+        if job.on_timeout is not None:
+            try:
+                await job.on_timeout()
+            except Exception:
+                pass
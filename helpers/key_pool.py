@@ -0,0 +1,147 @@
+import re
+import time
+
+DEFAULT_BENCH_SECONDS = 20.0
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value: str) -> float:
+    """
+    Parses a rate limit reset duration such as `1s`, `6m0s` or `250ms` into seconds.
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    matches = _DURATION.findall(value)
+    return sum(float(amount) * _UNITS[unit] for amount, unit in matches) if matches else None
+
+
+class KeyState:
+    """
+    What is known about the rate limits and usage of one API key.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.remaining_requests = None
+        self.remaining_tokens = None
+        self.reset_at = 0.0
+        self.benched_until = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+
+    @property
+    def name(self) -> str:
+        return f"...{self.key[-4:]}"
+
+    def headroom(self, now: float) -> tuple:
+        if now >= self.reset_at:
+            remaining_requests = remaining_tokens = float("inf")
+        else:
+            remaining_requests = float("inf") if self.remaining_requests is None else self.remaining_requests
+            remaining_tokens = float("inf") if self.remaining_tokens is None else self.remaining_tokens
+        return (remaining_requests - self.in_flight, remaining_tokens, -self.in_flight, -self.requests)
+
+
+class KeyPool:
+    """
+    Spreads API requests over several keys.
+
+    Every response updates the key's view of its rate limits from the `x-ratelimit-*` headers. Requests go to the key
+    with the most requests and tokens left, and a key that gets a 429 or runs out of either is benched until its
+    limits reset, so throughput scales with the number of keys instead of piling onto a throttled one.
+    """
+
+    def __init__(self, keys: list):
+        self.keys = [KeyState(key) for key in keys]
+        if not self.keys:
+            raise ValueError("At least one API key is required.")
+
+    @classmethod
+    def from_config(cls, value: str) -> "KeyPool":
+        """
+        Creates a pool from the comma-separated `openai_api_key` config value.
+        """
+        return cls([key.strip() for key in value.split(",") if key.strip()])
+
+    def _state(self, key: str) -> KeyState:
+        for state in self.keys:
+            if state.key == key:
+                return state
+        return None
+
+    def acquire(self) -> str:
+        """
+        Returns the key with the most headroom. If every key is benched, the one that comes back first is returned.
+        """
+        now = time.monotonic()
+        available = [state for state in self.keys if state.benched_until <= now]
+        if not available:
+            return min(self.keys, key=lambda state: state.benched_until).key
+        return max(available, key=lambda state: state.headroom(now)).key
+
+    def started(self, key: str) -> None:
+        state = self._state(key)
+        if state is not None:
+            state.in_flight += 1
+            state.requests += 1
+
+    def finished(self, key: str) -> None:
+        state = self._state(key)
+        if state is not None:
+            state.in_flight -= 1
+
+    def update(self, key: str, status: int, headers) -> None:
+        """
+        Records the rate limit headers and status of a response sent with the key.
+        """
+        state = self._state(key)
+        if state is None:
+            return
+        now = time.monotonic()
+        if headers.get("x-ratelimit-remaining-requests") is not None:
+            state.remaining_requests = int(headers["x-ratelimit-remaining-requests"])
+        if headers.get("x-ratelimit-remaining-tokens") is not None:
+            state.remaining_tokens = int(headers["x-ratelimit-remaining-tokens"])
+        reset_requests = parse_duration(headers.get("x-ratelimit-reset-requests"))
+        reset_tokens = parse_duration(headers.get("x-ratelimit-reset-tokens"))
+        resets = [reset for reset in (reset_requests, reset_tokens) if reset is not None]
+        if resets:
+            state.reset_at = now + max(resets)
+
+        if status == 429:
+            state.rate_limited += 1
+            retry_after = parse_duration(headers.get("retry-after"))
+            state.benched_until = now + (retry_after or max(resets, default=DEFAULT_BENCH_SECONDS))
+        elif state.remaining_requests == 0 and reset_requests is not None:
+            state.benched_until = now + reset_requests
+        elif state.remaining_tokens == 0 and reset_tokens is not None:
+            state.benched_until = now + reset_tokens
+        if status >= 400:
+            state.errors += 1
+
+    def stats(self) -> list:
+        """
+        Returns the usage counters of every key, identified by its last four characters.
+        """
+        now = time.monotonic()
+        return [
+            {
+                "key": state.name,
+                "requests": state.requests,
+                "errors": state.errors,
+                "rate_limited": state.rate_limited,
+                "in_flight": state.in_flight,
+                "remaining_requests": state.remaining_requests if now < state.reset_at else None,
+                "remaining_tokens": state.remaining_tokens if now < state.reset_at else None,
+                "benched_for": max(0.0, state.benched_until - now),
+            }
+            for state in self.keys
+        ]
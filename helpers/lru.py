@@ -0,0 +1,57 @@
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+
+class LRUCache:
+    """
+    A mapping that holds at most `maxsize` entries, evicting the least recently used one when it is full.
+
+    When `max_bytes` is set, the cache also evicts entries once the total size of its values, as measured by `sizeof`,
+    goes over that budget. A value larger than the whole budget is not cached at all.
+    """
+
+    def __init__(self, maxsize: int = 1024, max_bytes: int = None, sizeof: Callable[[Any], int] = len):
+        self.maxsize = max(1, maxsize)
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._sizes = {}
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Returns the cached value for the key and marks it as recently used.
+        """
+        if key not in self._entries:
+            return default
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """
+        Caches the value for the key, evicting the least recently used entries if the cache is full.
+        """
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        self.pop(key)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        self._entries[key] = value
+        self._sizes[key] = size
+        self.bytes += size
+        while len(self._entries) > self.maxsize or self.max_bytes is not None and self.bytes > self.max_bytes:
+            self.pop(next(iter(self._entries)))
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        self.bytes -= self._sizes.pop(key, 0)
+        return self._entries.pop(key, default)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._sizes.clear()
+        self.bytes = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
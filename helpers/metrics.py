@@ -0,0 +1,193 @@
+import functools
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+# latency buckets in seconds, from a cached lookup to a long completion
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_registry = []
+
+_runner = None
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple, values: tuple, extra: dict = None) -> str:
+    pairs = list(zip(names, values)) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    """
+    A value that only goes up, such as a number of requests, kept per combination of label values.
+    """
+
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(labels.get(name, "") for name in self.labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Gauge:
+    """
+    A value that goes up and down, such as a queue depth, kept per combination of label values.
+    """
+
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values = {}
+        _registry.append(self)
+
+    def set(self, value: float, **labels) -> None:
+        self._values[tuple(labels.get(name, "") for name in self.labels)] = value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge"]
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """
+    Counts observations, usually durations in seconds, into cumulative buckets kept per combination of label values.
+    """
+
+    def __init__(self, name: str, description: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        _registry.append(self)
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(labels.get(name, "") for name in self.labels)
+        counts = self._values.get(key)
+        if counts is None:
+            # one count per bucket, then the sum and the total count
+            counts = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        counts[-2] += value
+        counts[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes how long the block took, even if it raised.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def totals(self) -> dict:
+        """
+        Returns the number and sum of the observations for every combination of label values.
+        """
+        return {key: (counts[-1], counts[-2]) for key, counts in self._values.items()}
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for key, counts in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, {'le': bound})} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, {'le': '+Inf'})} {counts[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {counts[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {counts[-1]}")
+        return lines
+
+
+def timed(histogram: Histogram, **labels):
+    """
+    Decorates a coroutine function so that every call's duration is observed in the histogram.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return await function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def render() -> str:
+    """
+    Returns every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8", headers={"X-Content-Type-Options": "nosniff"})
+
+
+async def start(host: str = "127.0.0.1", port: int = 9464) -> None:
+    """
+    Serves the metrics at http://host:port/metrics. Raises OSError if the address can't be bound.
+    """
+    global _runner
+    if _runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError:
+        await runner.cleanup()
+        raise
+    _runner = runner
+
+
+async def close() -> None:
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
+
+
+DB_SECONDS = Histogram("osiris_db_seconds", "Time spent in database helpers.", ("helper",))
+MODERATION_SECONDS = Histogram("osiris_moderation_seconds", "Latency of moderation requests.")
+COMPLETION_SECONDS = Histogram("osiris_completion_seconds", "Latency of completions, retries included, until the whole reply is received.", ("model", "stream"))
+DISCORD_SEND_SECONDS = Histogram("osiris_discord_send_seconds", "Latency of sending or editing a message on Discord.")
+ON_MESSAGE_SECONDS = Histogram("osiris_on_message_seconds", "Time spent handling a message in the chat listener.")
+REPLY_SECONDS = Histogram("osiris_reply_seconds", "Time from the last message of a burst to the end of the reply, debounce included.")
+QUEUE_WAIT_SECONDS = Histogram("osiris_queue_wait_seconds", "Time jobs waited in a queue before a worker picked them up.", ("queue",))
+QUEUE_DEPTH = Gauge("osiris_queue_depth", "Jobs waiting in a queue.", ("queue",))
+QUEUE_RUNNING = Gauge("osiris_queue_running", "Jobs being run by a queue's workers.", ("queue",))
+
+MESSAGES_TOTAL = Counter("osiris_messages_total", "Messages received in enabled channels.", ("guild",))
+COMPLETIONS_TOTAL = Counter("osiris_completions_total", "Completions requested, by model and resulting status.", ("model", "status"))
+QUEUE_JOBS_TOTAL = Counter("osiris_queue_jobs_total", "Jobs submitted to a queue, by how they ended.", ("queue", "result"))
+ERRORS_TOTAL = Counter("osiris_errors_total", "Replies that failed, by error code or exception type.", ("code",))
@@ -0,0 +1,52 @@
+import os
+import re
+
+import aiosqlite
+
+MIGRATIONS_PATH = f"{os.path.realpath(os.path.dirname(__file__))}/../database/migrations"
+
+
+def get_migrations() -> list:
+    """
+    Returns the (version, path) of every migration script, ordered by version.
+
+    Migration scripts live in `database/migrations` and are named `<version>_<description>.sql`.
+    """
+    migrations = []
+    for file in os.listdir(MIGRATIONS_PATH):
+        match = re.match(r"^(\d+)_.+\.sql$", file)
+        if match:
+            migrations.append((int(match.group(1)), os.path.join(MIGRATIONS_PATH, file)))
+    return sorted(migrations)
+
+
+async def get_version(db: aiosqlite.Connection) -> int:
+    """
+    Returns the schema version of the database, as recorded in its `user_version` pragma.
+    """
+    async with db.execute("PRAGMA user_version") as cursor:
+        result = await cursor.fetchone()
+        return result[0] if result is not None else 0
+
+
+async def migrate(db: aiosqlite.Connection) -> list:
+    """
+    Applies every migration newer than the database's schema version and returns the versions applied.
+
+    Each migration runs in its own transaction together with the version bump, so a failing script leaves the
+    database at the last version that was fully applied.
+    """
+    current = await get_version(db)
+    applied = []
+    for version, path in get_migrations():
+        if version <= current:
+            continue
+        with open(path) as file:
+            script = file.read()
+        try:
+            await db.executescript(f"BEGIN;\n{script}\nPRAGMA user_version = {version};\nCOMMIT;")
+        except Exception:
+            await db.rollback()
+            raise
+        applied.append(version)
+    return applied
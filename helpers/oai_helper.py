@@ -1,44 +1,266 @@
-import aiohttp
+import asyncio
+import hashlib
+import json
 import os
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
+import aiohttp
+from helpers import completion_cache, db_manager, http_client, metrics
+from helpers.key_pool import KeyPool, parse_duration
+from helpers.lru import LRUCache
+from helpers.resilience import RETRYABLE_STATUSES, CircuitBreaker, CircuitOpenError, ResiliencePolicy, RetryableError
 
 API_BASE = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1")
 
-async def infer(messages: list, model: str, temp: float, API_KEY: str):
+MAX_TOKENS = 2048
+
+# how many inputs are sent to the moderation endpoint in one request
+MODERATION_BATCH_SIZE = 32
+
+_verdicts = LRUCache(10000)
+
+_persist_verdicts = True
 
-    headers = {
+keys = None
+
+completions = ResiliencePolicy(CircuitBreaker("completions"))
+
+_UPSTREAM_ERRORS = (RetryableError, CircuitOpenError, asyncio.TimeoutError, aiohttp.ClientError)
+
+def _headers(API_KEY: str) -> dict:
+    return {
         'Content-Type': 'application/json',
         'Authorization': f'Bearer {API_KEY}'
     }
 
-    # first we moderate the messages
-    messages_soup = ""
-    for message in messages:
-        messages_soup += f"{message}\n"
+def configure_resilience(retries: int = 2, deadline: float = 90.0, hedge_after: float = None, failure_threshold: int = 5, recovery_time: float = 30.0) -> None:
+    """
+    Sets how completion requests are retried, how long they may take in total, when a slow one is hedged, and when
+    the circuit breaker opens and how long it stays open.
+    """
+    global completions
+    completions = ResiliencePolicy(CircuitBreaker("completions", failure_threshold, recovery_time), retries=retries, deadline=deadline, hedge_after=hedge_after)
+
+def _error_status(error: Exception) -> int:
+    if isinstance(error, RetryableError):
+        return error.status
+    if isinstance(error, CircuitOpenError):
+        return 503
+    if isinstance(error, asyncio.TimeoutError):
+        return 504
+    return 502
 
-    url = f"{API_BASE}/moderations"
+def configure_keys(value: str) -> None:
+    """
+    Sets the API keys requests are spread over, from the comma-separated `openai_api_key` config value.
+    Called again whenever the config is reloaded.
+    """
+    global keys
+    previous = {state.key: state for state in keys.keys} if keys is not None else {}
+    keys = KeyPool.from_config(value)
+    # keep the rate limits and counters of the keys that were already in use
+    keys.keys = [previous.get(state.key, state) for state in keys.keys]
+
+@asynccontextmanager
+async def _post(path: str, payload: dict, API_KEY: str = None, stream: bool = False):
+    """
+    Sends a request to the API with the given key, or with the key that has the most headroom in the key pool,
+    and records the rate limits of the response. Streamed requests get the stream timeout instead of the session's.
+    """
+    API_KEY = API_KEY or keys.acquire()
+    keys.started(API_KEY)
+    options = {"timeout": http_client.get_stream_timeout()} if stream else {}
+    try:
+        async with http_client.get_session().post(f"{API_BASE}/{path}", json=payload, headers=_headers(API_KEY), **options) as response:
+            keys.update(API_KEY, response.status, response.headers)
+            yield response
+    finally:
+        keys.finished(API_KEY)
+
+def configure_moderation(cache_size: int = 10000, persist: bool = True) -> None:
+    """
+    Sets how many moderation verdicts are cached in memory and whether they are also stored in the database.
+    """
+    global _verdicts, _persist_verdicts
+    _verdicts = LRUCache(cache_size)
+    _persist_verdicts = persist
+
+async def moderate(inputs: list, API_KEY: str = None) -> list:
+    """
+    Sends the inputs to the moderation endpoint in a single request and returns whether each one is flagged,
+    or None if the request failed.
+    """
     payload = {
-        'data': messages_soup
+        'input': inputs
     }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=payload, headers=headers) as response:
-            if response.status == 200:
-                response_data = await response.json()
-                if response_data['results'][0]['flagged']:
-                    return 403
+    try:
+        with metrics.MODERATION_SECONDS.time():
+            async with _post("moderations", payload, API_KEY) as response:
+                if response.status == 200:
+                    response_data = await response.json()
+                    return [result['flagged'] for result in response_data['results']]
+    except (asyncio.TimeoutError, aiohttp.ClientError):
+        pass
+    return None
+
+async def get_verdicts(contents: list, API_KEY: str = None) -> list:
+    """
+    Returns whether each of the contents is flagged by moderation, with None for those that couldn't be moderated.
+
+    Verdicts are cached by content hash, in memory and optionally in the database, so only contents that have never
+    been moderated before are sent to the moderation endpoint, MODERATION_BATCH_SIZE at a time.
+    """
+    hashes = [hashlib.sha256(content.encode("utf-8")).hexdigest() if content else None for content in contents]
+    verdicts = {content_hash: _verdicts.get(content_hash) for content_hash in hashes if content_hash is not None}
+    missing = [content_hash for content_hash, flagged in verdicts.items() if flagged is None]
+    if missing and _persist_verdicts:
+        for content_hash, flagged in (await db_manager.get_moderation_verdicts(missing)).items():
+            _verdicts.set(content_hash, flagged)
+            verdicts[content_hash] = flagged
+        missing = [content_hash for content_hash in missing if verdicts[content_hash] is None]
+    if missing:
+        texts = {content_hash: content for content_hash, content in zip(hashes, contents) if content_hash is not None}
+        batches = [missing[i:i + MODERATION_BATCH_SIZE] for i in range(0, len(missing), MODERATION_BATCH_SIZE)]
+        results = await asyncio.gather(*(moderate([texts[content_hash] for content_hash in batch], API_KEY) for batch in batches))
+        for batch, flags in zip(batches, results):
+            for content_hash, flagged in zip(batch, flags or []):
+                _verdicts.set(content_hash, flagged)
+                verdicts[content_hash] = flagged
+                if _persist_verdicts:
+                    await db_manager.add_moderation_verdict(content_hash, flagged)
+    return [verdicts[content_hash] if content_hash is not None else False for content_hash in hashes]
+
+async def is_flagged(contents: list, API_KEY: str = None) -> bool:
+    """
+    Returns whether any of the contents is flagged by moderation. Usually only the newest message of the
+    conversation hasn't been moderated before.
+    """
+    return any(await get_verdicts(contents, API_KEY))
+
+def _upstream_down() -> bool:
+    """
+    Returns whether the completions circuit is open, in which case replies fail fast without even moderating.
+    """
+    return completions.breaker.state == CircuitBreaker.OPEN
+
+async def infer(messages: list, model: str, temp: float, API_KEY: str = None, moderation_inputs: list = None):
+    """
+    Returns the completion for the messages, or an error status code if it can't be generated. The messages'
+    contents are moderated first, or `moderation_inputs` instead when given.
+    """
+
+    if _upstream_down():
+        metrics.COMPLETIONS_TOTAL.inc(model=model, status=503)
+        return 503
+
+    # first we moderate the messages
+    if await is_flagged(moderation_inputs or [message['content'] for message in messages], API_KEY):
+        return 403
 
-    url = f"{API_BASE}/chat/completions"
     payload = {
         'model': model,
         'messages': messages,
         'temperature': temp,
-        'max_tokens': 2048
+        'max_tokens': MAX_TOKENS
     }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=payload, headers=headers) as response:
+    cache_key = completion_cache.key(model, temp, messages) if completion_cache.is_cacheable(temp) else None
+    if cache_key is not None:
+        content = await completion_cache.get(cache_key)
+        if content is not None:
+            return content
+
+    async def complete():
+        async with _post("chat/completions", payload, API_KEY) as response:
             if response.status == 200:
                 response_data = await response.json()
                 return response_data['choices'][0]['message']['content']
-            else:
-                return int(response.status)
+            if response.status in RETRYABLE_STATUSES:
+                raise RetryableError(response.status, parse_duration(response.headers.get("retry-after")))
+            return int(response.status)
+
+    try:
+        with metrics.COMPLETION_SECONDS.time(model=model, stream="false"):
+            content = await completions.call(complete)
+    except _UPSTREAM_ERRORS as e:
+        content = _error_status(e)
+    metrics.COMPLETIONS_TOTAL.inc(model=model, status=content if isinstance(content, int) else 200)
+    if cache_key is not None and not isinstance(content, int):
+        await completion_cache.put(cache_key, content)
+    return content
+
+async def infer_stream(messages: list, model: str, temp: float, API_KEY: str = None, moderation_inputs: list = None):
+    """
+    Streams the completion, yielding each piece of the reply as soon as the API sends it.
+    Like `infer`, the messages or `moderation_inputs` are moderated first, and a single error status code is yielded
+    instead if the reply can't be generated, or after the pieces already yielded if it breaks off midway.
+    """
+    if _upstream_down():
+        metrics.COMPLETIONS_TOTAL.inc(model=model, status=503)
+        yield 503
+        return
+
+    if await is_flagged(moderation_inputs or [message['content'] for message in messages], API_KEY):
+        yield 403
+        return
+
+    payload = {
+        'model': model,
+        'messages': messages,
+        'temperature': temp,
+        'max_tokens': MAX_TOKENS,
+        'stream': True
+    }
+
+    cache_key = completion_cache.key(model, temp, messages) if completion_cache.is_cacheable(temp) else None
+    if cache_key is not None:
+        content = await completion_cache.get(cache_key)
+        if content is not None:
+            yield content
+            return
+
+    async def open_stream():
+        stack = AsyncExitStack()
+        response = await stack.enter_async_context(_post("chat/completions", payload, API_KEY, stream=True))
+        if response.status in RETRYABLE_STATUSES:
+            await stack.aclose()
+            raise RetryableError(response.status, parse_duration(response.headers.get("retry-after")))
+        return stack, response
+
+    started = time.perf_counter()
+    # only opening the stream is retried, a reply that has started streaming can't be replayed
+    try:
+        stack, response = await completions.call(open_stream, hedge=False)
+    except _UPSTREAM_ERRORS as e:
+        metrics.COMPLETIONS_TOTAL.inc(model=model, status=_error_status(e))
+        yield _error_status(e)
+        return
+
+    metrics.COMPLETIONS_TOTAL.inc(model=model, status=response.status)
+    pieces = []
+    async with stack:
+        if response.status != 200:
+            yield int(response.status)
+            return
+        # the body is a stream of server-sent events, one `data: <json>` line per chunk
+        try:
+            async for line in response.content:
+                line = line.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    metrics.COMPLETION_SECONDS.observe(time.perf_counter() - started, model=model, stream="true")
+                    # only a reply that streamed to the end is cached
+                    if cache_key is not None and pieces:
+                        await completion_cache.put(cache_key, "".join(pieces))
+                    return
+                choices = json.loads(data).get('choices') or [{}]
+                content = choices[0].get('delta', {}).get('content')
+                if content:
+                    pieces.append(content)
+                    yield content
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            # the reply broke off midway, report it so the partial reply is followed by an error
+            yield _error_status(e)
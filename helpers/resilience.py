@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Awaitable, Callable
+
+import aiohttp
+
+logger = logging.getLogger("discord_bot")
+
+# statuses worth retrying: timeouts, conflicts, rate limits and server errors
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class RetryableError(Exception):
+    """
+    Raised by a request that failed in a way that may succeed when retried.
+    """
+
+    def __init__(self, status: int, retry_after: float = None):
+        super().__init__(f"Upstream returned status {status}.")
+        self.status = status
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of sending a request while the circuit breaker is open.
+    """
+
+    def __init__(self):
+        super().__init__("Upstream is unhealthy, failing fast.")
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to an upstream that keeps failing.
+
+    After `failure_threshold` consecutive failures the breaker opens and every call fails fast for `recovery_time`
+    seconds. It then lets a single trial request through (half-open): a success closes it again, a failure opens it
+    for another `recovery_time`.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_time: float = 30.0):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.recovery_time = recovery_time
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.last_error = None
+        self._state = self.CLOSED
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self.opened_at >= self.recovery_time:
+            return self.HALF_OPEN
+        return self._state
+
+    def allow(self) -> bool:
+        """
+        Returns whether a request may be sent now.
+        """
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        if self._state != self.CLOSED:
+            logger.info(f"Circuit breaker '{self.name}' closed, upstream has recovered.")
+        self._state = self.CLOSED
+        self.failures = 0
+        self._trial_in_flight = False
+
+    def record_failure(self, error: str) -> None:
+        self.failures += 1
+        self.last_error = error
+        if self._trial_in_flight or self._state == self.CLOSED and self.failures >= self.failure_threshold:
+            self._state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.times_opened += 1
+            logger.warning(f"Circuit breaker '{self.name}' opened after {self.failures} failures, last error: {error}")
+        self._trial_in_flight = False
+
+    def record_cancelled(self) -> None:
+        self._trial_in_flight = False
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "state": self.state,
+            "failures": self.failures,
+            "times_opened": self.times_opened,
+            "last_error": self.last_error,
+            "retry_in": max(0.0, self.recovery_time - (time.monotonic() - self.opened_at)) if self._state == self.OPEN else 0.0,
+        }
+
+
+class ResiliencePolicy:
+    """
+    Wraps upstream calls with a deadline, retries with jittered exponential backoff and a circuit breaker.
+
+    A call is attempted up to `retries + 1` times within `deadline` seconds. Between attempts it waits a random
+    time up to `backoff_base * 2 ** attempt` seconds (capped at `backoff_cap`), or longer if the upstream asked for it
+    with `retry-after`. With `hedge_after` set, an attempt that hasn't finished after that many seconds is raced
+    against a second, identical one, and the first to succeed wins.
+    """
+
+    def __init__(self, breaker: CircuitBreaker, retries: int = 2, deadline: float = 90.0, backoff_base: float = 0.5, backoff_cap: float = 8.0, hedge_after: float = None):
+        self.breaker = breaker
+        self.retries = max(0, retries)
+        self.deadline = deadline
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.hedge_after = hedge_after
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    async def call(self, request: Callable[[], Awaitable[Any]], hedge: bool = True) -> Any:
+        """
+        Calls `request` until it returns without raising a RetryableError, a timeout or a connection error.
+        Raises CircuitOpenError without calling it while the breaker is open, or the last error once the attempts or
+        the deadline run out.
+        """
+        started = time.monotonic()
+        for attempt in range(self.retries + 1):
+            if not self.breaker.allow():
+                raise CircuitOpenError()
+            remaining = self.deadline - (time.monotonic() - started)
+            try:
+                result = await asyncio.wait_for(self._attempt(request, hedge), remaining)
+            except (RetryableError, asyncio.TimeoutError, aiohttp.ClientError) as e:
+                self.breaker.record_failure(f"{type(e).__name__}: {e}")
+                delay = max(self.backoff(attempt), getattr(e, "retry_after", None) or 0)
+                if attempt == self.retries or delay >= self.deadline - (time.monotonic() - started):
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # cancelled or failed in an unexpected way, which says nothing about the upstream's health
+                self.breaker.record_cancelled()
+                raise
+            self.breaker.record_success()
+            return result
+
+    async def _attempt(self, request: Callable[[], Awaitable[Any]], hedge: bool) -> Any:
+        if not hedge or self.hedge_after is None:
+            return await request()
+        tasks = [asyncio.ensure_future(request())]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_after)
+            if not done:
+                tasks.append(asyncio.ensure_future(request()))
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,139 @@
+import math
+import os
+import re
+
+from helpers.lru import LRUCache
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# context window of each model family, matched on the longest prefix of the model name
+CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-3.5-turbo-1106": 16385,
+    "gpt-3.5-turbo-0125": 16385,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-1106": 128000,
+    "gpt-4-0125": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+}
+
+DEFAULT_CONTEXT_WINDOW = 4096
+
+# every message costs a few tokens on top of its content, and the reply is primed with a few more
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+# encoding of each model family, matched like CONTEXT_WINDOWS
+ENCODINGS = {
+    "gpt-4o": "o200k_base",
+}
+
+DEFAULT_ENCODING = "cl100k_base"
+
+# the BPE ranks of every encoding, named like tiktoken's cache entries (the SHA-1 of their download URL)
+ENCODINGS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "encodings")
+
+_PIECES = re.compile(r"\s?\w+|\s?[^\w\s]+|\s+")
+
+_encodings = {}
+
+_counts = LRUCache(20000)
+
+def load() -> bool:
+    """
+    Loads the BPE encodings used to count tokens and returns whether they are all available.
+
+    The ranks are bundled in ENCODINGS_DIR and tiktoken is pointed at them as its cache, so nothing is downloaded.
+    Models whose encoding isn't available get estimated token counts instead, slightly overcounting to stay on the
+    safe side.
+    """
+    if tiktoken is None:
+        return False
+    os.environ["TIKTOKEN_CACHE_DIR"] = ENCODINGS_DIR
+    names = {DEFAULT_ENCODING, *ENCODINGS.values()}
+    for name in names:
+        try:
+            _encodings[name] = tiktoken.get_encoding(name)
+        except Exception:
+            _encodings.pop(name, None)
+    return names <= _encodings.keys()
+
+def _match(table: dict, model: str):
+    matches = [name for name in table if model.startswith(name)]
+    return table[max(matches, key=len)] if matches else None
+
+def context_window(model: str) -> int:
+    """
+    Returns the context window of the model, in tokens.
+    """
+    return _match(CONTEXT_WINDOWS, model) or DEFAULT_CONTEXT_WINDOW
+
+def encoding_name(model: str) -> str:
+    """
+    Returns the name of the encoding the model uses.
+    """
+    return _match(ENCODINGS, model) or DEFAULT_ENCODING
+
+def _estimate(piece: str) -> int:
+    return max(1, math.ceil(len(piece.encode("utf-8")) / 4))
+
+def _count(text: str, encoding) -> int:
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return sum(_estimate(piece) for piece in _PIECES.findall(text))
+
+def _truncate(text: str, max_tokens: int, encoding) -> str:
+    if encoding is not None:
+        return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+    end = 0
+    for match in _PIECES.finditer(text):
+        max_tokens -= _estimate(match.group())
+        if max_tokens < 0:
+            break
+        end = match.end()
+    return text[:end]
+
+def count(text: str, model: str = "") -> int:
+    """
+    Returns the number of tokens in the text for the model. Counts are memoized, so recounting the same message is
+    free.
+    """
+    if not text:
+        return 0
+    name = encoding_name(model)
+    tokens = _counts.get((name, text))
+    if tokens is None:
+        tokens = _count(text, _encodings.get(name))
+        _counts.set((name, text), tokens)
+    return tokens
+
+def truncate(text: str, max_tokens: int, model: str = "") -> str:
+    """
+    Returns the longest start of the text that fits in `max_tokens` tokens for the model.
+    """
+    if max_tokens <= 0:
+        return ""
+    if count(text, model) <= max_tokens:
+        return text
+    return _truncate(text, max_tokens, _encodings.get(encoding_name(model)))
+
+def fit(text: str, max_tokens: int, model: str = "") -> tuple:
+    """
+    Returns the longest start of the text that fits in `max_tokens` tokens for the model, and its number of tokens.
+
+    Unlike `count` and `truncate` it doesn't touch the memoized counts, so it can run in a thread for long texts.
+    """
+    if not text or max_tokens <= 0:
+        return "", 0
+    encoding = _encodings.get(encoding_name(model))
+    tokens = _count(text, encoding)
+    if tokens <= max_tokens:
+        return text, tokens
+    excerpt = _truncate(text, max_tokens, encoding)
+    return excerpt, _count(excerpt, encoding)
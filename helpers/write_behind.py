@@ -0,0 +1,84 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, List
+
+logger = logging.getLogger("discord_bot")
+
+
+class WriteBehindQueue:
+    """
+    Buffers rows in memory and hands them to `write` in batches from a background task.
+
+    A batch is written as soon as `batch_size` rows are pending or `flush_interval` seconds after its first row
+    arrived, whichever comes first, so callers never wait on the database. Once `max_pending` rows are buffered,
+    `put` waits for the writer to catch up instead of growing the buffer without bound.
+    """
+
+    def __init__(self, write: Callable[[List[Any]], Awaitable[None]], batch_size: int = 500, flush_interval: float = 0.25, max_pending: int = 50000):
+        self.write = write
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self._queue = asyncio.Queue(maxsize=max_pending)
+        self._full = asyncio.Event()
+        self._task = None
+
+    def start(self) -> None:
+        """
+        Starts the background writer.
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """
+        Writes everything still pending and stops the background writer.
+        """
+        if self._task is None:
+            return
+        await self.flush()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def put(self, row: Any) -> None:
+        """
+        Queues a row to be written with the next batch.
+        """
+        await self._queue.put(row)
+        if self._queue.qsize() >= self.batch_size:
+            self._full.set()
+
+    async def flush(self) -> None:
+        """
+        Waits until every row queued so far has been written.
+        """
+        if self._task is None:
+            return
+        self._full.set()
+        await self._queue.join()
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            if self._queue.qsize() < self.batch_size - 1 and not self._full.is_set():
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._full.clear()
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self.write(batch)
+            except Exception as e:
+                logger.error(f"Failed to write {len(batch)} queued rows: {type(e).__name__}: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()